@@ -0,0 +1,92 @@
+# EXPLAIN ANALYZE comparison of the original daily analytics query and the pre-aggregated one.
+#
+#   python -m benchmarks.explain_daily_mart --seed-scale 1000   # ~10M diary_records and user_activity rows in bench_sf1000
+#   python -m benchmarks.explain_daily_mart                     # compare on the data already loaded
+# Seeding is subject to the same schema guard as benchmarks/run.py: never the application schema, and a --schema
+# outside of bench_* needs --recreate.
+import argparse
+import re
+
+from src.analytics import create_daily_analytics_data_mart, daily_analytics_select
+from src.utils import pooled, ensure_schema
+
+
+# the query populate_data_mart used before the per-source aggregation: it joins records and payments of the
+# same timestamp and relies on COUNT(DISTINCT ...) to undo the cross-product
+def legacy_daily_analytics_select(schema: str) -> str:
+    return f"""
+    WITH date_table AS (
+        SELECT DISTINCT COALESCE(dr.created_on, p.payment_date) AS date
+        FROM {schema}.diary_records dr
+        FULL JOIN {schema}.payments p ON dr.created_on = p.payment_date
+    )
+    SELECT 
+        dt.date,
+        COUNT(DISTINCT d.user_id) AS total_active_users,
+        COUNT(DISTINCT dr.record_id) AS total_diary_records,
+        AVG(LENGTH(dr.text)) AS average_text_length,
+        COUNT(DISTINCT p.payment_id) AS total_subscription,
+        SUM(p.amount) AS total_revenue
+    FROM date_table dt
+    LEFT JOIN {schema}.diary_records dr ON dt.date = dr.created_on
+    LEFT JOIN {schema}.diaries d ON dr.diary_id = d.diary_id
+    LEFT JOIN {schema}.payments p ON dt.date = p.payment_date
+    GROUP BY dt.date
+    """
+
+
+def explain(cursor, query, params=None):
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {query}", params)
+    plan = [row[0] for row in cursor.fetchall()]
+    match = re.search(r"Execution Time: ([\d.]+) ms", plan[-1])
+    return plan, float(match.group(1)) if match else None
+
+
+def compare(schema: str, verbose: bool = False):
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {schema}.diary_records")
+            records = cursor.fetchone()[0]
+            cursor.execute(f"SELECT COUNT(*) FROM {schema}.payments")
+            payments = cursor.fetchone()[0]
+            cursor.execute(f"SELECT date(MAX(created_on)) FROM {schema}.diary_records")
+            last_day = cursor.fetchone()[0]
+            print(f"diary_records: {records}, payments: {payments}\n")
+
+            cases = [
+                ('legacy, full history', legacy_daily_analytics_select(schema), None),
+                ('pre-aggregated, full history', daily_analytics_select(schema, days_filter=False), None),
+                ('pre-aggregated, last day only', daily_analytics_select(schema, days_filter=True), {'days': [last_day]}),
+            ]
+            for name, query, params in cases:
+                plan, ms = explain(cursor, query, params)
+                print(f"{name}: {ms:,.0f} ms")
+                if verbose:
+                    print('\n'.join(plan) + '\n')
+            conn.rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed-scale', type=float, default=0,
+                        help="bulk-seed this scale factor first (1000 = 1M users, 10M diary records)")
+    parser.add_argument('--schema', default=None,
+                        help="defaults to bench_sf<scale> when seeding, to the application schema otherwise")
+    parser.add_argument('--recreate', action='store_true',
+                        help="allow seeding a --schema that isn't named bench_*")
+    parser.add_argument('--verbose', action='store_true', help="print the full plans")
+    args = parser.parse_args()
+
+    if args.seed_scale:
+        from benchmarks.run import seed_schema_error, prepare_schema
+
+        schema = args.schema or f"bench_sf{args.seed_scale:g}".replace('.', '_')
+        error = seed_schema_error(schema, args.recreate)
+        if error:
+            parser.error(error)
+        prepare_schema(schema, args.seed_scale, workers=None)
+    else:
+        schema = args.schema or ensure_schema(drop_if_exists=False)
+    create_daily_analytics_data_mart(schema)
+
+    compare(schema, verbose=args.verbose)
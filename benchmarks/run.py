@@ -0,0 +1,301 @@
+# End-to-end benchmark of the real code paths against the Postgres and Redis configured in .env.
+#
+#   python -m benchmarks.run --scale 10 --output sf10.json          # seed 10 000 users into bench_sf10, run every case
+#   python -m benchmarks.run --scale 10 --skip-seed --output new.json
+#   python -m benchmarks.run --compare sf10.json new.json            # flag regressions, exit code 1 if any
+#
+# Seeding drops the tables of the schema: a --schema outside of bench_* needs --recreate, and the application schema
+# (SCHEMA_NAME) is never used.
+#
+# Scale factor 1 is 1 000 users with 10 diary records, 10 activities and 1 payment each (see src/seeding.py),
+# so --scale 1000 gives 10M diary records for the search cases.
+# The database modules are imported on demand, so --compare works without them.
+import argparse
+import datetime
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, ops=None):
+    latencies = sorted(latencies)
+    ops = len(latencies) if ops is None else ops
+    return {
+        'ops': ops,
+        'seconds': elapsed,
+        'throughput': ops / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def measure(fn, iterations):
+    # runs fn(i) `iterations` times and summarizes the per-call latencies
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        call_started = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; children covers the seeding workers
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'self': own / 1024, 'children': children / 1024}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed_schema_error(schema, recreate):
+    # seeding writes generated rows into the schema (and run.py drops its tables first): never the application
+    # schema, and anything else than bench_* only when asked to. Returns the reason to refuse, or None.
+    from decouple import config
+
+    if schema == config('SCHEMA_NAME', default=None):
+        return f"{schema} is the application schema (SCHEMA_NAME), refusing to seed it; pick another --schema"
+    if not schema.startswith('bench_') and not recreate:
+        return f"seeding drops the tables of {schema}, pass --recreate to confirm or use a bench_* schema"
+    return None
+
+
+def prepare_schema(schema, scale, workers):
+    from src.seeding import seed_tables_bulk
+    from src.utils import pooled, drop_tables, create_tables
+
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+        conn.commit()
+    drop_tables(schema)
+    create_tables(schema)
+
+    started = time.perf_counter()
+    tables = seed_tables_bulk(schema, scale, workers=workers)
+    elapsed = time.perf_counter() - started
+    rows = sum(table['rows'] for table in tables.values())
+    result = summarize([elapsed], elapsed, ops=rows)
+    result['tables'] = tables
+    return result
+
+
+def sample_ids(schema, iterations, rnd):
+    from src.utils import pooled
+
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT MIN(user_id), MAX(user_id) FROM {schema}.users")
+            low, high = cursor.fetchone()
+            cursor.execute(f"SELECT plan_id FROM {schema}.subscription_plans")
+            plans = [row[0] for row in cursor.fetchall()]
+            cursor.execute(f"SELECT text FROM {schema}.diary_records LIMIT %s", (iterations, ))
+            texts = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    return [rnd.randint(low, high) for _ in range(iterations)], plans, texts
+
+
+def run_benchmarks(schema, scale, iterations, seed, workers):
+    from src.analytics import create_daily_analytics_data_mart, populate_data_mart
+    from src.console_ui import recalc_actions_datamart, find_users
+    from src.redis_utils import TrendingTopics, get_redis
+    from src.payments import pay_subscription, pay_subscriptions
+    from src.search import search_diary_records
+    from src.diary_import import import_diary_entries
+    from src.utils import pooled, ensure_diary_search
+
+    rnd = random.Random(0)
+    results = {}
+
+    if seed:
+        print("seeding...")
+        results['seed'] = prepare_schema(schema, scale, workers)
+
+    users, plans, texts = sample_ids(schema, iterations, rnd)
+
+    print("populate_data_mart...")
+    create_daily_analytics_data_mart(schema)
+    results['populate_data_mart_full'] = measure(lambda i: populate_data_mart(schema, full=True), 1)
+    results['populate_data_mart_incremental'] = measure(lambda i: populate_data_mart(schema), 3)
+
+    print("recalc_actions_datamart per event...")
+
+    def record_event(i):
+        with pooled() as conn:
+            dt = datetime.datetime.now()
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {schema}.user_activity (user_id, activity_type, activity_date) VALUES (%s, %s, %s)",
+                    (users[i], 'login', dt))
+            recalc_actions_datamart(conn, schema, activity_type='login', date=dt)
+            conn.commit()
+
+    results['recalc_actions_datamart'] = measure(record_event, iterations)
+
+    print("trending...")
+    # a separate key prefix keeps the benchmark out of the live trending window
+    trending = TrendingTopics(client=get_redis(), prefix=f"{schema}.bench")
+    results['update_trending'] = measure(lambda i: trending.update_trending(texts[i % len(texts)]), iterations)
+    results['get_trending'] = measure(lambda i: trending.get_trending(), iterations)
+
+    print("login lookup...")
+
+    def login_lookup(i):
+        # seeded emails are user<id>@..., so this is a selective prefix like a user typing the start of their email
+        with pooled() as conn:
+            find_users(conn, schema, f"user{users[i]}")
+            conn.commit()
+
+    results['login_lookup'] = measure(login_lookup, iterations)
+
+    print("diary search...")
+    ensure_diary_search(schema)  # only adds something to a --skip-seed schema created before the search columns
+    # query words come from the seeded texts; at --scale 1000 the search runs over 10M diary records
+    words = [word.strip('.,').lower() for text in texts for word in text.split() if len(word) > 5]
+    queries = [' '.join(rnd.sample(words, 2)) for _ in range(iterations)]
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT tag_list[1] FROM {schema}.diary_records WHERE tag_list IS NOT NULL LIMIT %s",
+                           (iterations, ))
+            tags = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+
+    def search(query='', tags=(), pages=1):
+        with pooled() as conn:
+            after = None
+            for _ in range(pages):
+                _, after = search_diary_records(conn, schema, query, tags, after=after)
+                if after is None:
+                    break
+            conn.commit()
+
+    results['search_one_word'] = measure(lambda i: search(queries[i].split()[0]), iterations)
+    results['search_two_words'] = measure(lambda i: search(queries[i]), iterations)
+    results['search_three_pages'] = measure(lambda i: search(queries[i].split()[0], pages=3), iterations)
+    results['search_tag'] = measure(lambda i: search(tags=[tags[i % len(tags)]]), iterations)
+
+    print("diary import...")
+    entries = [{'user_id': users[i % len(users)], 'text': texts[i % len(texts)], 'tags': ['bench', 'import'],
+                'created_on': datetime.datetime.now() - datetime.timedelta(minutes=rnd.randrange(60 * 24 * 30))}
+               for i in range(iterations * 100)]
+    started = time.perf_counter()
+    import_diary_entries(schema, entries, trending=trending)
+    elapsed = time.perf_counter() - started
+    results['diary_import'] = summarize([elapsed], elapsed, ops=len(entries))
+
+    print("pay_subscription...")
+    today = datetime.date.today()
+    results['pay_subscription'] = measure(
+        lambda i: pay_subscription(users[i], rnd.choice(plans), today, schema=schema), iterations)
+
+    # batch API under contention: every payment goes to one of 10 hot users, topped up so that they never run out
+    hot_users = users[:10]
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"UPDATE {schema}.users SET balance = 1e12 WHERE user_id = ANY(%s)", (hot_users, ))
+        conn.commit()
+
+    for name, targets in (('pay_subscriptions_batch', users), ('pay_subscriptions_hot_users', hot_users)):
+        batch = [(rnd.choice(targets), rnd.choice(plans), today) for _ in range(iterations * 10)]
+        started = time.perf_counter()
+        outcome = pay_subscriptions(batch, schema=schema, workers=workers or 8)
+        elapsed = time.perf_counter() - started
+        results[name] = summarize([elapsed], elapsed, ops=len(batch))
+        results[name]['succeeded'] = sum(result.ok for result in outcome)
+
+    return results
+
+
+def compare(base_path, new_path, threshold):
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    regressions = 0
+    print(f"{'case':<34}{'base ops/s':>14}{'new ops/s':>14}{'base p95':>11}{'new p95':>11}")
+    for case, old in base['results'].items():
+        current = new['results'].get(case)
+        if current is None:
+            print(f"{case:<34}{'missing in new run':>50}")
+            continue
+
+        flags = []
+        if old['throughput'] and current['throughput'] < old['throughput'] * (1 - threshold):
+            flags.append('throughput')
+        if old['p95_ms'] and current['p95_ms'] > old['p95_ms'] * (1 + threshold):
+            flags.append('p95')
+        regressions += bool(flags)
+
+        print(f"{case:<34}{old['throughput']:>14,.1f}{current['throughput']:>14,.1f}"
+              f"{old['p95_ms']:>11.2f}{current['p95_ms']:>11.2f}  {'REGRESSION: ' + ', '.join(flags) if flags else ''}")
+
+    if base['meta']['scale'] != new['meta']['scale']:
+        print(f"\nwarning: runs use different scale factors ({base['meta']['scale']} vs {new['meta']['scale']})")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end benchmark with TPC-style scale factors")
+    parser.add_argument('--scale', type=float, default=1, help="1 = 1 000 users")
+    parser.add_argument('--schema', default=None, help="defaults to bench_sf<scale>, dropped and reseeded")
+    parser.add_argument('--recreate', action='store_true',
+                        help="allow dropping the tables of a --schema that isn't named bench_*")
+    parser.add_argument('--iterations', type=int, default=1000, help="operations per per-event case")
+    parser.add_argument('--workers', type=int, default=None, help="seeding processes")
+    parser.add_argument('--skip-seed', action='store_true', help="reuse the data already in the schema")
+    parser.add_argument('--output', default=None, help="write the results as JSON here")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help="compare two result files")
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative change flagged as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    schema = args.schema or f"bench_sf{args.scale:g}".replace('.', '_')
+    if not args.skip_seed:
+        error = seed_schema_error(schema, args.recreate)
+        if error:
+            parser.error(error)
+    results = run_benchmarks(schema, args.scale, args.iterations, not args.skip_seed, args.workers)
+
+    report = {
+        'meta': {
+            'scale': args.scale,
+            'schema': schema,
+            'iterations': args.iterations,
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+        },
+        'results': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+    print(f"\n{'case':<34}{'ops/s':>14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for case, result in results.items():
+        print(f"{case:<34}{result['throughput']:>14,.1f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+    print(f"peak RSS: {report['peak_rss_mb']['self']:.0f} MB (seeding workers {report['peak_rss_mb']['children']:.0f} MB)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
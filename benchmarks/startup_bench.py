@@ -0,0 +1,88 @@
+# Startup cost of the main.py commands: the modules each command imports are loaded in fresh interpreters with
+# -X importtime, and the import time is reported with the slowest modules.
+#
+#   python -m benchmarks.startup_bench                        # every command, exit code 1 if a target is missed
+#   python -m benchmarks.startup_bench --command interact --runs 10 --target-ms 250
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what each command of main.py imports by the time it starts working
+COMMAND_MODULES = {
+    'interact': ['src.console_ui'],
+    'refresh-marts': ['src.analytics'],
+    'visualize': ['src.analytics', 'matplotlib.pyplot'],
+    'seed': ['src.seeding'],
+}
+
+# the interactive path has to start quickly and must not load any of these
+TARGETS_MS = {'interact': 300}
+HEAVY_PACKAGES = ('pandas', 'numpy', 'matplotlib', 'nltk', 'faker', 'bcrypt')
+
+
+def import_profile(modules):
+    # -> (import time of the whole process in ms, wall time in ms, [(module, self us, cumulative us, depth)])
+    code = '; '.join(['import main'] + [f'import {module}' for module in modules])
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True)
+    wall = (time.perf_counter() - started) * 1000
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    entries = []
+    for line in result.stderr.splitlines():
+        # import time: <self us> | <cumulative us> | <two spaces per nesting level><module>
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    total = sum(cumulative for _, _, cumulative, depth in entries if depth == 0) / 1000
+    return total, wall, entries
+
+
+def bench_command(command, runs, top):
+    profiles = [import_profile(COMMAND_MODULES[command]) for _ in range(runs)]
+    import_ms = statistics.median(total for total, _, _ in profiles)
+    wall_ms = statistics.median(wall for _, wall, _ in profiles)
+
+    entries = profiles[-1][2]
+    loaded = {name.split('.')[0] for name, _, _, _ in entries}
+    heavy = [package for package in HEAVY_PACKAGES if package in loaded]
+
+    print(f"\n{command}: {import_ms:.0f} ms of imports, {wall_ms:.0f} ms wall (median of {runs}), {len(entries)} modules")
+    if heavy:
+        print(f"  heavy packages: {', '.join(heavy)}")
+    for name, self_us, cumulative_us, _ in sorted(entries, key=lambda entry: entry[1], reverse=True)[:top]:
+        print(f"  {self_us / 1000:>8.1f} ms self {cumulative_us / 1000:>8.1f} ms cumulative  {name}")
+    return import_ms, heavy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import time of the main.py commands")
+    parser.add_argument('--command', choices=list(COMMAND_MODULES), action='append', default=None)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="slowest modules to list")
+    parser.add_argument('--target-ms', type=float, default=None, help="override the target of the interactive path")
+    args = parser.parse_args()
+
+    targets = dict(TARGETS_MS)
+    if args.target_ms is not None:
+        targets['interact'] = args.target_ms
+
+    failed = False
+    for command in args.command or COMMAND_MODULES:
+        import_ms, heavy = bench_command(command, args.runs, args.top)
+        target = targets.get(command)
+        if target is not None:
+            ok = import_ms <= target and not heavy
+            failed |= not ok
+            print(f"  target {target:.0f} ms without heavy packages: {'ok' if ok else 'MISSED'}")
+
+    sys.exit(1 if failed else 0)
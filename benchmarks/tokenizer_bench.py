@@ -0,0 +1,75 @@
+# Words/sec of the trending tokenizer before and after the precompiled regex + frozenset stopwords.
+#
+#   python -m benchmarks.tokenizer_bench --entries 2000
+import argparse
+import random
+import re
+import string
+import time
+from collections import Counter
+
+from src.tokenizer import Tokenizer, STOPWORDS_DIR, load_stopwords
+
+
+def _stopwords_list():
+    # the original code called nltk's stopwords.words('english') per word, which re-reads the corpus file
+    # and returns a fresh list; without a downloaded corpus the bundled copy is read the same way
+    try:
+        from nltk.corpus import stopwords
+        stopwords.words('english')
+        return lambda: stopwords.words('english')
+    except (ImportError, LookupError):
+        def read_list():
+            with open(f'{STOPWORDS_DIR}/stopwords_english.txt', encoding='utf-8') as f:
+                return [line.strip() for line in f]
+        return read_list
+
+
+def legacy_count(text, stopwords_words):
+    words = re.findall(r'\b\w{4,}\b', text.lower())
+    words = [word for word in words if word not in stopwords_words()]
+    return Counter(words)
+
+
+def make_entries(count, seed=0):
+    # diary-like text: a mix of stopwords and random words, ~80 words per entry
+    rnd = random.Random(seed)
+    stop = sorted(load_stopwords())
+    vocabulary = [''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(3, 10))) for _ in range(5000)]
+    return [
+        ' '.join(rnd.choice(stop) if rnd.random() < 0.4 else rnd.choice(vocabulary) for _ in range(80)).capitalize() + '.'
+        for _ in range(count)
+    ]
+
+
+def count_each(count, entries):
+    counts = Counter()
+    for entry in entries:
+        counts.update(count(entry))
+    return counts
+
+
+def measure(name, fn, entries, total_words):
+    started = time.perf_counter()
+    result = fn(entries)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<28}{total_words / elapsed:>14,.0f} words/s")
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=2000)
+    args = parser.parse_args()
+
+    entries = make_entries(args.entries)
+    total_words = sum(len(entry.split()) for entry in entries)
+    stopwords_words = _stopwords_list()
+    tokenizer = Tokenizer()
+
+    before = measure('before (per entry)', lambda es: count_each(lambda e: legacy_count(e, stopwords_words), es),
+                     entries, total_words)
+    per_entry = measure('after (per entry)', lambda es: count_each(tokenizer.count, es), entries, total_words)
+    batch = measure('after (batch)', tokenizer.count_many, entries, total_words)
+
+    assert before == per_entry == batch
@@ -1,21 +1,148 @@
-from src.analytics import create_daily_analytics_data_mart, populate_data_mart, visualize_data_mart
-from src.console_ui import start_interaction
-from src.utils import create_tables, seed_tables, ensure_schema, drop_tables
+import argparse
+import datetime
 
 
-if __name__ == '__main__':
-    # ans = input("Do you want to recreate the database (y/n)?")
-    ans = 'n'
-    if ans == 'y':
+# Every command imports what it needs when it runs: `interact` never loads pandas, matplotlib, Faker or bcrypt.
+# Without a command main.py refreshes the marts, shows the chart and starts the interaction, as it always did.
+#   python main.py seed --scale 10 --recreate
+#   python main.py seed --demo                   # drop the schema and seed a few users with Faker
+#   python main.py refresh-marts --full --reconcile-days 7
+#   python main.py visualize --output chart.png chart.svg --from 2024-01-01
+#   python main.py interact
+# `python -m benchmarks.startup_bench` measures the import time of each command.
+
+
+def migrate():
+    # idempotent schema upgrades of an existing database
+    from decouple import config
+    from src.utils import ensure_schema, ensure_activity_datamart_key, maintain_activity_partitions, \
+        ensure_user_lookup_indexes, ensure_diary_search
+
+    schema = ensure_schema(drop_if_exists=False)
+    ensure_activity_datamart_key(schema)
+    maintain_activity_partitions(schema)
+    ensure_user_lookup_indexes(schema)
+    ensure_diary_search(schema)
+    if config('MART_CDC', default=False, cast=bool):
+        from src.cdc import ensure_mart_cdc
+        ensure_mart_cdc(schema)
+    return schema
+
+
+def seed(args):
+    from src.utils import ensure_schema, drop_tables, create_tables
+
+    if args.demo:
         schema = ensure_schema(drop_if_exists=True)
         drop_tables(schema)
         create_tables(schema)
+
+        from src.utils import seed_tables
         seed_tables(schema)
-    else:
-        schema = ensure_schema(drop_if_exists=False)
+        return
+
+    from src.seeding import seed_tables_bulk
+
+    schema = ensure_schema(drop_if_exists=False)
+    if args.recreate:
+        drop_tables(schema)
+    create_tables(schema)
+    seed_tables_bulk(schema, args.scale, records_per_user=args.records_per_user, workers=args.workers)
+
+
+def refresh_marts(args):
+    from src.analytics import create_daily_analytics_data_mart, populate_data_mart, reconcile_actions_datamart, \
+        active_users_report
+
+    schema = migrate()
+    today = datetime.date.today()
+    if args.reconcile_days:
+        reconcile_actions_datamart(schema, today - datetime.timedelta(days=args.reconcile_days - 1), today)
+    if args.active_users_report:
+        active_users_report(schema, today - datetime.timedelta(days=args.active_users_report - 1), today)
+
+    create_daily_analytics_data_mart(schema)
+    populate_data_mart(schema, full=args.full)
+    return schema
+
+
+def visualize(args, schema=None):
+    from src.analytics import visualize_data_mart
+    from src.utils import ensure_schema
+
+    schema = schema or ensure_schema(drop_if_exists=False)
+    visualize_data_mart(schema, args.output, args.date_from, args.date_to, args.granularity)
 
-        create_daily_analytics_data_mart(schema)
-        populate_data_mart(schema)
-        visualize_data_mart(schema)
 
-        start_interaction(schema)
+def interact(args, schema=None):
+    from src.console_ui import start_interaction
+    from src.utils import ensure_schema
+
+    start_interaction(schema or ensure_schema(drop_if_exists=False))
+
+
+def default(args):
+    schema = refresh_marts(args)
+    visualize(args, schema)
+    interact(args, schema)
+
+
+def add_refresh_arguments(parser):
+    parser.add_argument('--full', action='store_true',
+                        help="rebuild the daily analytics mart from the whole history instead of refreshing new days")
+    parser.add_argument('--reconcile-days', type=int, default=0,
+                        help="recompute the activity mart counters of the last N days and fix drifted ones")
+    parser.add_argument('--active-users-report', type=int, default=0, metavar='N',
+                        help="compare the approximate active user counts of the last N days with exact ones")
+
+
+def add_visualize_arguments(parser, prefix=''):
+    parser.add_argument(f'--{prefix}output', dest='output', nargs='+', default=[], metavar='FILE',
+                        help="render the daily analytics chart into these files (.png, .svg) instead of a window")
+    parser.add_argument(f'--{prefix}from', dest='date_from', type=datetime.date.fromisoformat, default=None,
+                        help="first day of the chart")
+    parser.add_argument(f'--{prefix}to', dest='date_to', type=datetime.date.fromisoformat, default=None,
+                        help="last day of the chart")
+    parser.add_argument(f'--{prefix}granularity', dest='granularity', choices=('day', 'week', 'month'), default=None,
+                        help="bucket size, chosen from the length of the range by default")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--query-report', action='store_true',
+                        help="print the recorded SQL statements by total time before exiting")
+    # the options of the default run (refresh-marts, visualize and interact)
+    add_refresh_arguments(parser)
+    add_visualize_arguments(parser, prefix='plot-')
+    parser.set_defaults(command=default)
+    commands = parser.add_subparsers(title='commands')
+
+    seed_parser = commands.add_parser('seed', help="load generated data")
+    seed_parser.add_argument('--scale', type=float, default=1, help="scale factor, 1 000 users per unit")
+    seed_parser.add_argument('--records-per-user', type=int, default=10)
+    seed_parser.add_argument('--workers', type=int, default=None, help="processes, defaults to the CPU count")
+    seed_parser.add_argument('--recreate', action='store_true', help="drop and recreate the tables first")
+    seed_parser.add_argument('--demo', action='store_true',
+                             help="drop the schema and seed a few users with Faker instead of the bulk load")
+    seed_parser.set_defaults(command=seed)
+
+    refresh_parser = commands.add_parser('refresh-marts', help="migrate the schema and refresh the marts")
+    add_refresh_arguments(refresh_parser)
+    refresh_parser.set_defaults(command=refresh_marts)
+
+    visualize_parser = commands.add_parser('visualize', help="plot the daily active users")
+    add_visualize_arguments(visualize_parser)
+    visualize_parser.set_defaults(command=visualize)
+
+    interact_parser = commands.add_parser('interact', help="log in and write diary records")
+    interact_parser.set_defaults(command=interact)
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    args.command(args)
+
+    if args.query_report:
+        from src.instrumentation import query_stats, print_report
+        print_report(query_stats)
@@ -1,76 +1,427 @@
-import matplotlib.pyplot as plt
-import pandas as pd
+import datetime
 
-from src.utils import connect
-from src.redis_utils import TrendingTopics
+from decouple import config
+
+from src.utils import pooled
+from src.cache import invalidate_hourly_activity
+from src.redis_utils import get_active_users
 
 
 def create_daily_analytics_data_mart(schema: str):
-    conn = connect()
-    with conn.cursor() as cursor:
-        query = f"""
-        CREATE TABLE IF NOT EXISTS {schema}.daily_analytics_data_mart (
-            date DATE,
-            total_active_users INTEGER,
-            total_diary_records INTEGER,
-            average_text_length FLOAT,
-            total_subscription INTEGER,
-            total_revenue FLOAT
-        );
-        """
-        cursor.execute(query)
-        conn.commit()
-    conn.close()
-
-
-def populate_data_mart(schema: str):
-    conn = connect()
-    with conn.cursor() as cursor:
-        query = f"""
-        INSERT INTO {schema}.daily_analytics_data_mart (
-            date, 
-            total_active_users, -- users with diary record today
-            total_diary_records, 
-            average_text_length,
-            total_subscription,
-            total_revenue
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            query = f"""
+            CREATE TABLE IF NOT EXISTS {schema}.daily_analytics_data_mart (
+                date DATE PRIMARY KEY,
+                total_active_users INTEGER,
+                total_diary_records INTEGER,
+                average_text_length FLOAT,
+                total_subscription INTEGER,
+                total_revenue FLOAT
+            );
+            """
+            cursor.execute(query)
+
+            # marts created before the date key existed may hold duplicated days: keep one row per date
+            # (it is recomputed by the next refresh anyway) and add the key afterwards
+            cursor.execute(
+                f"""
+                DELETE FROM {schema}.daily_analytics_data_mart a
+                USING {schema}.daily_analytics_data_mart b
+                WHERE a.date = b.date AND a.ctid < b.ctid
+                """
+            )
+            cursor.execute(f"DELETE FROM {schema}.daily_analytics_data_mart WHERE date IS NULL")
+            cursor.execute(
+                f"""
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                                   WHERE conrelid = '{schema}.daily_analytics_data_mart'::regclass AND contype = 'p') THEN
+                        ALTER TABLE {schema}.daily_analytics_data_mart ADD PRIMARY KEY (date);
+                    END IF;
+                END
+                $$;
+                """
+            )
+
+            # high-water marks of the source tables already folded into each mart
+            query = f"""
+            CREATE TABLE IF NOT EXISTS {schema}.mart_watermarks (
+                mart VARCHAR(255) NOT NULL,
+                source VARCHAR(255) NOT NULL,
+                last_id BIGINT NOT NULL,
+                refreshed_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (mart, source)
+            );
+            """
+            cursor.execute(query)
+
+            # the per-day aggregation reads the sources by date range and joins records to diaries
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_diary_records_created_on ON {schema}.diary_records(created_on);""")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_diary_records_diary_id ON {schema}.diary_records(diary_id);""")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_payments_payment_date ON {schema}.payments(payment_date);""")
+            conn.commit()
+
+
+def daily_analytics_select(schema: str, days_filter: bool) -> str:
+    # Each source is aggregated per calendar day on its own and the per-day results are merged afterwards,
+    # so the intermediate result is one row per day and source instead of records x payments per day.
+    # days_filter restricts the aggregation to the days passed as the %(days)s array parameter; the
+    # range join against them keeps the predicates sargable for the created_on / payment_date indexes.
+    days_cte = "days AS (SELECT DISTINCT unnest(%(days)s::date[]) AS date)," if days_filter else ""
+    dr_days = "JOIN days ON dr.created_on >= days.date AND dr.created_on < days.date + 1" if days_filter else ""
+    p_days = "JOIN days ON p.payment_date >= days.date AND p.payment_date < days.date + 1" if days_filter else ""
+
+    return f"""
+    WITH {days_cte}
+    diary_daily AS (
+        SELECT
+            date(dr.created_on) AS date,
+            COUNT(DISTINCT d.user_id) AS total_active_users, -- users with diary record today
+            COUNT(*) AS total_diary_records,
+            AVG(LENGTH(dr.text)) AS average_text_length
+        FROM {schema}.diary_records dr
+        JOIN {schema}.diaries d ON dr.diary_id = d.diary_id
+        {dr_days}
+        GROUP BY date(dr.created_on)
+    ),
+    payments_daily AS (
+        SELECT
+            date(p.payment_date) AS date,
+            COUNT(*) AS total_subscription,
+            SUM(p.amount) AS total_revenue
+        FROM {schema}.payments p
+        {p_days}
+        GROUP BY date(p.payment_date)
+    )
+    SELECT
+        COALESCE(dd.date, pd.date) AS date,
+        COALESCE(dd.total_active_users, 0) AS total_active_users,
+        COALESCE(dd.total_diary_records, 0) AS total_diary_records,
+        dd.average_text_length,
+        COALESCE(pd.total_subscription, 0) AS total_subscription,
+        COALESCE(pd.total_revenue, 0) AS total_revenue
+    FROM diary_daily dd
+    FULL JOIN payments_daily pd ON dd.date = pd.date
+    """
+
+
+def _daily_analytics_query(schema: str, days_filter: bool) -> str:
+    return f"""
+    INSERT INTO {schema}.daily_analytics_data_mart (
+        date, 
+        total_active_users,
+        total_diary_records, 
+        average_text_length,
+        total_subscription,
+        total_revenue
+    )
+    {daily_analytics_select(schema, days_filter)}
+    ON CONFLICT (date) DO UPDATE SET
+        total_active_users = EXCLUDED.total_active_users,
+        total_diary_records = EXCLUDED.total_diary_records,
+        average_text_length = EXCLUDED.average_text_length,
+        total_subscription = EXCLUDED.total_subscription,
+        total_revenue = EXCLUDED.total_revenue;
+    """
+
+
+def rebuild_daily_days(cursor, schema: str, days):
+    # Recompute the daily mart rows of `days`: days without any records or payments any more are removed,
+    # the others upserted. Running it again gives the same rows.
+    days = sorted(set(days))
+    cursor.execute(f"DELETE FROM {schema}.daily_analytics_data_mart WHERE date = ANY(%s::date[])", (days, ))
+    cursor.execute(_daily_analytics_query(schema, days_filter=True), {'days': days})
+    return cursor.rowcount
+
+
+def rebuild_daily_range(cursor, schema: str, first_day: datetime.date, last_day: datetime.date):
+    return rebuild_daily_days(cursor, schema, [first_day + datetime.timedelta(days=i)
+                                               for i in range((last_day - first_day).days + 1)])
+
+
+# source tables of the daily mart with their serial key and timestamp column
+DAILY_MART_SOURCES = {
+    'diary_records': ('record_id', 'created_on'),
+    'payments': ('payment_id', 'payment_date'),
+}
+
+
+def daily_mart_high_water(cursor, schema: str):
+    # the newest row of every source; rows up to these ids are reflected once the aggregation that follows commits
+    high_water = {}
+    for source, (id_column, _) in DAILY_MART_SOURCES.items():
+        cursor.execute(f"SELECT COALESCE(MAX({id_column}), 0) FROM {schema}.{source}")
+        high_water[source] = cursor.fetchone()[0]
+    return high_water
+
+
+def save_watermarks(cursor, schema: str, high_water: dict):
+    for source, last_id in high_water.items():
+        cursor.execute(
+            f"""
+            INSERT INTO {schema}.mart_watermarks (mart, source, last_id, refreshed_at)
+            VALUES ('daily_analytics_data_mart', %s, %s, now())
+            ON CONFLICT (mart, source) DO UPDATE SET last_id = EXCLUDED.last_id, refreshed_at = EXCLUDED.refreshed_at
+            """,
+            (source, last_id)
         )
-        WITH date_table AS (
-            SELECT DISTINCT COALESCE(dr.created_on, p.payment_date) AS date
-            FROM psyassist.diary_records dr
-            FULL JOIN psyassist.payments p ON dr.created_on = p.payment_date
+
+
+def populate_data_mart(schema: str, full: bool = False):
+    # Incremental by default: only the days touched by rows added since the previous run are recomputed. full=True (or a mart that was never refreshed) rebuilds the whole history.
+    # Serial ids are handed out before commit, so a row with an id below the previous high-water mark can commit
+    # after that run: the last MART_WATERMARK_LOOKBACK ids of every source are scanned again. The days since the
+    # previous run are always recomputed as well, which picks up recent updates and deletes; older changes need
+    # full=True (or the change data capture of src/cdc.py).
+    lookback = config('MART_WATERMARK_LOOKBACK', default=10000, cast=int)
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""SELECT source, last_id, refreshed_at FROM {schema}.mart_watermarks
+                WHERE mart = 'daily_analytics_data_mart'"""
+            )
+            rows = cursor.fetchall()
+            watermarks = {source: last_id for source, last_id, _ in rows}
+            previous_run = min((refreshed_at for _, _, refreshed_at in rows), default=None)
+            if set(watermarks) != set(DAILY_MART_SOURCES):
+                full = True
+
+            # new high-water marks are taken before aggregating; rows committed meanwhile go to the next run
+            high_water = daily_mart_high_water(cursor, schema)
+            if any(high_water[source] < last_id for source, last_id in watermarks.items() if source in high_water):
+                # the sources were recreated since the previous run and their ids started over
+                full = True
+
+            if full:
+                cursor.execute(f"TRUNCATE {schema}.daily_analytics_data_mart")
+                cursor.execute(_daily_analytics_query(schema, days_filter=False))
+                print(f"Daily analytics mart rebuilt: {cursor.rowcount} days.")
+            else:
+                touched = " UNION ".join(
+                    [f"SELECT date({date_column}) FROM {schema}.{source} "
+                     f"WHERE {id_column} > %({source}_from)s AND {id_column} <= %({source}_to)s"
+                     for source, (id_column, date_column) in DAILY_MART_SOURCES.items()]
+                    + ["SELECT day::date FROM generate_series(date(%(since)s), current_date, '1 day') day"]
+                )
+                params = {'since': previous_run}
+                for source in DAILY_MART_SOURCES:
+                    params[f'{source}_from'] = max(watermarks[source] - lookback, 0)
+                    params[f'{source}_to'] = high_water[source]
+                cursor.execute(touched, params)
+                days = [row[0] for row in cursor.fetchall()]
+
+                if days:
+                    # deletes as well: a day whose rows are all gone loses its mart row
+                    rebuild_daily_days(cursor, schema, days)
+                print(f"Daily analytics mart refreshed: {len(days)} days.")
+
+            save_watermarks(cursor, schema, high_water)
+            conn.commit()
+
+
+def reconcile_activity_range(cursor, schema: str, start: datetime.datetime, end: datetime.datetime):
+    # Upsert the activity mart slices of [start, end) recomputed from user_activity where they differ and delete
+    # the slices that have no activity any more. Returns (fixed, removed).
+    cursor.execute(
+        f"""
+        WITH actual AS (
+            SELECT activity_type, date(activity_date) AS activity_date,
+                   EXTRACT(HOUR FROM activity_date)::int AS activity_hour, COUNT(*) AS activity_count
+            FROM {schema}.user_activity
+            WHERE activity_date >= %(start)s AND activity_date < %(end)s
+            GROUP BY 1, 2, 3
+        ),
+        fixed AS (
+            INSERT INTO {schema}.user_activity_datamart (activity_type, activity_date, activity_hour, activity_count)
+            SELECT activity_type, activity_date, activity_hour, activity_count FROM actual
+            ON CONFLICT (activity_type, activity_date, activity_hour) DO UPDATE
+            SET activity_count = EXCLUDED.activity_count
+            WHERE {schema}.user_activity_datamart.activity_count <> EXCLUDED.activity_count
+            RETURNING 1
+        ),
+        removed AS (
+            DELETE FROM {schema}.user_activity_datamart m
+            WHERE m.activity_date BETWEEN date(%(start)s) AND date(%(end)s)
+              AND m.activity_date + m.activity_hour * interval '1 hour' >= %(start)s
+              AND m.activity_date + m.activity_hour * interval '1 hour' < %(end)s
+              AND NOT EXISTS (
+                  SELECT 1 FROM actual a
+                  WHERE a.activity_type = m.activity_type AND a.activity_date = m.activity_date
+                    AND a.activity_hour = m.activity_hour
+              )
+            RETURNING 1
         )
-        SELECT 
-            dt.date,
-            COUNT(DISTINCT d.user_id) AS total_active_users,
-            COUNT(DISTINCT dr.record_id) AS total_diary_records,
-            AVG(LENGTH(dr.text)) AS average_text_length,
-            COUNT(DISTINCT p.payment_id) AS total_subscription,
-            SUM(p.amount) AS total_revenue
-        FROM date_table dt
-        LEFT JOIN psyassist.diary_records dr ON dt.date = dr.created_on
-        LEFT JOIN psyassist.diaries d ON dr.diary_id = d.diary_id
-        LEFT JOIN psyassist.payments p ON dt.date = p.payment_date
-        GROUP BY dt.date;
-        """
-        cursor.execute(query)
+        SELECT (SELECT COUNT(*) FROM fixed), (SELECT COUNT(*) FROM removed)
+        """,
+        {'start': start, 'end': end}
+    )
+    return cursor.fetchone()
+
+
+def activity_reconcile_bounds(date_from: datetime.date, date_to: datetime.date):
+    # [start, end) of the days, without the current hour: its counters are still being bumped and overwriting
+    # them from a snapshot would lose concurrent increments
+    start = datetime.datetime.combine(date_from, datetime.time())
+    end = min(datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time()),
+              datetime.datetime.now().replace(minute=0, second=0, microsecond=0))
+    return start, end
+
+
+def reconcile_actions_datamart(schema: str, date_from: datetime.date, date_to: datetime.date):
+    # Recompute the activity mart slices of [date_from, date_to] from user_activity and fix the ones that drifted
+    # from the incrementally maintained counters.
+    start, end = activity_reconcile_bounds(date_from, date_to)
+    if start >= end:
+        return 0, 0
+
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            fixed, removed = reconcile_activity_range(cursor, schema, start, end)
+            conn.commit()
+
+    if fixed or removed:
+        invalidate_hourly_activity(schema, [start.date() + datetime.timedelta(days=i)
+                                            for i in range((end.date() - start.date()).days + 1)])
+
+    print(f"Activity mart reconciled from {start} to {end}: {fixed} slices fixed, {removed} removed.")
+    return fixed, removed
+
+
+def active_users_report(schema: str, date_from: datetime.date, date_to: datetime.date):
+    # Compare the HyperLogLog estimates of distinct active users with exact COUNT(DISTINCT) over user_activity:
+    # DAU for every day of [date_from, date_to], WAU and MAU ending on date_to.
+    active_users = get_active_users(schema)
+    start = datetime.datetime.combine(date_from, datetime.time())
+    end = datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time())
+    week_start = datetime.datetime.combine(date_to - datetime.timedelta(days=6), datetime.time())
+    month_start = datetime.datetime.combine(date_to - datetime.timedelta(days=29), datetime.time())
+
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT date(activity_date), COUNT(DISTINCT user_id) FROM {schema}.user_activity
+                WHERE activity_date >= %(start)s AND activity_date < %(end)s
+                GROUP BY 1
+                """,
+                {'start': start, 'end': end}
+            )
+            exact_days = dict(cursor.fetchall())
+            cursor.execute(
+                f"""
+                SELECT COUNT(DISTINCT user_id) FILTER (WHERE activity_date >= %(week_start)s),
+                       COUNT(DISTINCT user_id)
+                FROM {schema}.user_activity
+                WHERE activity_date >= %(month_start)s AND activity_date < %(end)s
+                """,
+                {'week_start': week_start, 'month_start': month_start, 'end': end}
+            )
+            exact_wau, exact_mau = cursor.fetchone()
         conn.commit()
-    conn.close()
 
+    rows = []
+    for i in range((date_to - date_from).days + 1):
+        day = date_from + datetime.timedelta(days=i)
+        rows.append((f"DAU {day}", exact_days.get(day, 0), active_users.day(day)))
+    rows.append((f"WAU {date_to}", exact_wau, active_users.wau(date_to)))
+    rows.append((f"MAU {date_to}", exact_mau, active_users.mau(date_to)))
+
+    print(f"{'':<16}{'exact':>10}{'estimate':>10}{'error':>9}")
+    for name, exact, estimate in rows:
+        error = f"{(estimate - exact) / exact * 100:>8.2f}%" if exact else f"{'-':>9}"
+        print(f"{name:<16}{exact:>10}{estimate:>10}{error}")
+    return rows
+
+
+# granularity -> (longest range in days drawn at it, start of the bucket a day falls into, bar width in days)
+GRANULARITIES = {
+    'day': (92, lambda day: day, 0.8),
+    'week': (731, lambda day: day - datetime.timedelta(days=day.weekday()), 6),
+    'month': (None, lambda day: day.replace(day=1), 25),
+}
+
+
+def choose_granularity(date_from: datetime.date, date_to: datetime.date) -> str:
+    days = (date_to - date_from).days + 1
+    for granularity, (max_days, _, _) in GRANULARITIES.items():
+        if max_days is None or days <= max_days:
+            return granularity
+
+
+def data_mart_range(schema: str):
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT MIN(date), MAX(date) FROM {schema}.daily_analytics_data_mart")
+            first_day, last_day = cursor.fetchone()
+        conn.commit()
+    return first_day, last_day
+
+
+def stream_data_mart(schema: str, date_from: datetime.date, date_to: datetime.date, granularity: str = 'day',
+                     column: str = 'total_active_users', chunk_size: int = 5000):
+    # Yields (bucket start, daily average of `column` over the days of the bucket) for [date_from, date_to].
+    # Rows are read by a server-side cursor `chunk_size` at a time in date order and folded into the current
+    # bucket as they arrive, so memory doesn't grow with the number of days.
+    _, bucket_of, _ = GRANULARITIES[granularity]
+    with pooled() as conn:
+        with conn.cursor(name='stream_data_mart') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(
+                f"""SELECT date, {column} FROM {schema}.daily_analytics_data_mart
+                WHERE date BETWEEN %s AND %s ORDER BY date""",
+                (date_from, date_to))
+
+            bucket, total, days = None, 0, 0
+            for day, value in cursor:
+                start = bucket_of(day)
+                if start != bucket:
+                    if days:
+                        yield bucket, total / days
+                    bucket, total, days = start, 0, 0
+                total += value or 0
+                days += 1
+            if days:
+                yield bucket, total / days
+        conn.commit()
+
+
+def visualize_data_mart(schema: str, outputs=(), date_from: datetime.date = None, date_to: datetime.date = None,
+                        granularity: str = None):
+    # Plot the active users of [date_from, date_to] (the whole mart by default) per day, week or month depending on
+    # the length of the range. With `outputs` the chart is rendered without a display into those files (the
+    # format follows the extension, e.g. .png or .svg), otherwise it is shown in a window.
+    first_day, last_day = data_mart_range(schema)
+    date_from = max(date_from or first_day, first_day) if first_day else None
+    date_to = min(date_to or last_day, last_day) if last_day else None
+    if date_from is None or date_from > date_to:
+        print("No daily analytics to plot.")
+        return None
 
-def visualize_data_mart(schema: str):
-    conn = connect()
-    query = f"SELECT * FROM {schema}.daily_analytics_data_mart;"
-    df = pd.read_sql(query, conn)
-    conn.close()
+    granularity = granularity or choose_granularity(date_from, date_to)
+    points = list(stream_data_mart(schema, date_from, date_to, granularity))
 
-    # Plotting the bar chart
-    plt.figure(figsize=(10, 6))
-    plt.bar(df['date'], df['total_active_users'])
-    plt.xlabel('Date')
-    plt.ylabel('Total Active Users')
-    plt.title('Daily Active Users')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
+    # matplotlib takes longer to import than everything else main.py needs, only pay for it when plotting. A bare
+    # Figure draws without pyplot's GUI backend, so files can be rendered on a headless server.
+    if outputs:
+        from matplotlib.figure import Figure
+        figure = Figure(figsize=(10, 6))
+    else:
+        import matplotlib.pyplot as plt
+        figure = plt.figure(figsize=(10, 6))
+    ax = figure.subplots()
+    ax.bar([bucket for bucket, _ in points], [value for _, value in points],
+           width=GRANULARITIES[granularity][2], align='edge')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Total Active Users' if granularity == 'day' else f'Active Users (daily average per {granularity})')
+    ax.set_title(f'Daily Active Users, {date_from} - {date_to}')
+    figure.autofmt_xdate(rotation=45)
+    figure.tight_layout()
 
+    for output in outputs:
+        figure.savefig(output)
+        print(f"Chart saved to {output}")
+    if not outputs:
+        plt.show()
+    return figure
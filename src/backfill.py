@@ -0,0 +1,235 @@
+import argparse
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from decouple import config
+from psycopg2.extras import Json
+
+from src.analytics import create_daily_analytics_data_mart, rebuild_daily_range, reconcile_activity_range, \
+    activity_reconcile_bounds, daily_mart_high_water, save_watermarks, DAILY_MART_SOURCES
+from src.cache import invalidate_hourly_activity
+from src.utils import pooled, get_pool, ensure_schema
+
+
+# Parallel backfill of the marts: the date range is split into chunks of `chunk_days` days, each recomputed by
+# an idempotent statement in its own transaction on a pooled connection, `workers` chunks at a time. A finished
+# chunk is recorded in backfill_chunks in the same transaction, so an interrupted backfill resumes with the
+# chunks that were not committed yet.
+#
+#   python -m src.backfill daily_analytics_data_mart --workers 8 --chunk-days 7
+#   python -m src.backfill all --from 2024-01-01 --to 2024-06-30 --restart
+
+
+def _daily_chunk(cursor, schema, first_day, last_day):
+    return rebuild_daily_range(cursor, schema, first_day, last_day)
+
+
+def _activity_chunk(cursor, schema, first_day, last_day):
+    # the current hour is skipped like in reconcile_actions_datamart, its counters are being bumped concurrently
+    start, end = activity_reconcile_bounds(first_day, last_day)
+    if start >= end:
+        return 0
+    fixed, removed = reconcile_activity_range(cursor, schema, start, end)
+    return fixed + removed
+
+
+# mart -> (chunk function, source tables with the timestamp column that decides the day)
+BACKFILL_MARTS = {
+    'daily_analytics_data_mart': (_daily_chunk, {source: column for source, (_, column) in DAILY_MART_SOURCES.items()}),
+    'user_activity_datamart': (_activity_chunk, {'user_activity': 'activity_date'}),
+}
+
+
+def create_backfill_tables(schema: str):
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {schema}.backfill_runs (
+                    mart TEXT PRIMARY KEY,
+                    date_from DATE NOT NULL,
+                    date_to DATE NOT NULL,
+                    chunk_days INTEGER NOT NULL,
+                    whole_history BOOLEAN NOT NULL,
+                    high_water JSONB,
+                    started_at TIMESTAMP NOT NULL,
+                    finished_at TIMESTAMP
+                );
+                """
+            )
+            cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {schema}.backfill_chunks (
+                    mart TEXT NOT NULL,
+                    chunk_from DATE NOT NULL,
+                    chunk_to DATE NOT NULL,
+                    changed_rows INTEGER NOT NULL,
+                    finished_at TIMESTAMP NOT NULL,
+                    PRIMARY KEY (mart, chunk_from)
+                );
+                """
+            )
+            conn.commit()
+
+
+def _source_range(cursor, schema, sources):
+    # first and last day with any source row; MIN/MAX of the indexed timestamps
+    days = []
+    for source, column in sources.items():
+        cursor.execute(f"SELECT MIN({column})::date, MAX({column})::date FROM {schema}.{source}")
+        days.extend(day for day in cursor.fetchone() if day is not None)
+    return (min(days), max(days)) if days else (None, None)
+
+
+def _chunks(date_from, date_to, chunk_days):
+    chunks = []
+    first_day = date_from
+    while first_day <= date_to:
+        last_day = min(first_day + datetime.timedelta(days=chunk_days - 1), date_to)
+        chunks.append((first_day, last_day))
+        first_day = last_day + datetime.timedelta(days=1)
+    return chunks
+
+
+def _start_run(schema, mart, date_from, date_to, chunk_days, restart):
+    # Resumes the unfinished run of the mart if it covers the same range, otherwise starts a new one.
+    # Returns the run (date_from, date_to, chunk_days, whole_history) and the first days of its finished chunks.
+    _, sources = BACKFILL_MARTS[mart]
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""SELECT date_from, date_to, chunk_days, whole_history, finished_at
+                FROM {schema}.backfill_runs WHERE mart = %s FOR UPDATE""",
+                (mart, ))
+            run = cursor.fetchone()
+
+            if (run and run[4] is None and not restart
+                    and date_from in (None, run[0]) and date_to in (None, run[1])):
+                cursor.execute(f"SELECT chunk_from FROM {schema}.backfill_chunks WHERE mart = %s", (mart, ))
+                finished = {row[0] for row in cursor.fetchall()}
+                conn.commit()
+                print(f"{mart}: resuming the backfill of {run[0]} - {run[1]}, {len(finished)} chunks already done.")
+                return run[:4], finished
+
+            whole_history = date_from is None and date_to is None
+            first_day, last_day = _source_range(cursor, schema, sources)
+            date_from = date_from or first_day
+            date_to = date_to or last_day
+            if date_from is None or date_to is None:
+                conn.commit()
+                return None, set()
+
+            # rows newer than the high-water marks taken now are left to the next incremental refresh
+            high_water = daily_mart_high_water(cursor, schema) if mart == 'daily_analytics_data_mart' else None
+
+            cursor.execute(f"DELETE FROM {schema}.backfill_chunks WHERE mart = %s", (mart, ))
+            cursor.execute(
+                f"""
+                INSERT INTO {schema}.backfill_runs
+                    (mart, date_from, date_to, chunk_days, whole_history, high_water, started_at, finished_at)
+                VALUES (%s, %s, %s, %s, %s, %s, now(), NULL)
+                ON CONFLICT (mart) DO UPDATE SET
+                    date_from = EXCLUDED.date_from, date_to = EXCLUDED.date_to, chunk_days = EXCLUDED.chunk_days,
+                    whole_history = EXCLUDED.whole_history, high_water = EXCLUDED.high_water,
+                    started_at = EXCLUDED.started_at, finished_at = NULL
+                """,
+                (mart, date_from, date_to, chunk_days, whole_history, Json(high_water)))
+            conn.commit()
+    return (date_from, date_to, chunk_days, whole_history), set()
+
+
+def _run_chunk(schema, mart, first_day, last_day):
+    chunk, _ = BACKFILL_MARTS[mart]
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            changed = chunk(cursor, schema, first_day, last_day)
+            cursor.execute(
+                f"""
+                INSERT INTO {schema}.backfill_chunks (mart, chunk_from, chunk_to, changed_rows, finished_at)
+                VALUES (%s, %s, %s, %s, now())
+                ON CONFLICT (mart, chunk_from) DO UPDATE SET
+                    chunk_to = EXCLUDED.chunk_to, changed_rows = EXCLUDED.changed_rows, finished_at = EXCLUDED.finished_at
+                """,
+                (mart, first_day, last_day, changed))
+            conn.commit()
+    return changed
+
+
+def _finish_run(schema, mart, whole_history):
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {schema}.backfill_runs SET finished_at = now() WHERE mart = %s RETURNING high_water", (mart, ))
+            high_water = cursor.fetchone()[0]
+            # after a backfill of the whole history the incremental refresh can continue from where it started
+            if mart == 'daily_analytics_data_mart' and whole_history:
+                save_watermarks(cursor, schema, high_water)
+            conn.commit()
+
+
+def backfill(schema: str, mart: str, date_from: datetime.date = None, date_to: datetime.date = None,
+             chunk_days: int = None, workers: int = None, restart: bool = False):
+    # Recompute `mart` for [date_from, date_to] (by default every day that has source rows). restart=True
+    # discards the progress of an interrupted run instead of resuming it.
+    chunk_days = chunk_days or config('BACKFILL_CHUNK_DAYS', default=7, cast=int)
+    workers = workers or config('BACKFILL_WORKERS', default=4, cast=int)
+    # a worker waiting for a connection longer than the pool timeout would fail its chunk
+    max_size = get_pool().max_size
+    if workers > max_size:
+        print(f"Using {max_size} workers, the size of the connection pool (DATABASE_POOL_MAX).")
+        workers = max_size
+
+    run, finished = _start_run(schema, mart, date_from, date_to, chunk_days, restart)
+    if run is None:
+        print(f"{mart}: no source rows, nothing to backfill.")
+        return 0
+    date_from, date_to, chunk_days, whole_history = run
+
+    chunks = _chunks(date_from, date_to, chunk_days)
+    pending = [chunk for chunk in chunks if chunk[0] not in finished]
+    print(f"{mart}: {len(pending)} of {len(chunks)} chunks of {chunk_days} days to compute with {workers} workers.")
+
+    started = time.perf_counter()
+    changed = 0
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(_run_chunk, schema, mart, first_day, last_day) for first_day, last_day in pending]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                changed += future.result()
+                if done % max(1, len(pending) // 20) == 0 or done == len(pending):
+                    print(f"  {done}/{len(pending)} chunks, {changed} rows changed, "
+                          f"{time.perf_counter() - started:.1f}s")
+        except BaseException:
+            # chunks already running commit with their checkpoint, the queued ones are left for the resume
+            for future in futures:
+                future.cancel()
+            raise
+
+    _finish_run(schema, mart, whole_history)
+
+    if mart == 'user_activity_datamart':
+        invalidate_hourly_activity(schema, [date_from + datetime.timedelta(days=i)
+                                            for i in range((date_to - date_from).days + 1)])
+
+    print(f"{mart}: backfilled {date_from} - {date_to} in {time.perf_counter() - started:.1f}s.")
+    return changed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recompute the marts over a date range in parallel chunks")
+    parser.add_argument('mart', choices=[*BACKFILL_MARTS, 'all'])
+    parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat, default=None,
+                        help="first day, defaults to the oldest source row")
+    parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat, default=None,
+                        help="last day, defaults to the newest source row")
+    parser.add_argument('--chunk-days', type=int, default=None, help="days per chunk (BACKFILL_CHUNK_DAYS)")
+    parser.add_argument('--workers', type=int, default=None, help="chunks computed at once (BACKFILL_WORKERS)")
+    parser.add_argument('--restart', action='store_true', help="discard the progress of an interrupted run")
+    args = parser.parse_args()
+
+    schema = ensure_schema(drop_if_exists=False)
+    create_daily_analytics_data_mart(schema)
+    create_backfill_tables(schema)
+    for mart in (BACKFILL_MARTS if args.mart == 'all' else [args.mart]):
+        backfill(schema, mart, args.date_from, args.date_to, args.chunk_days, args.workers, args.restart)
@@ -0,0 +1,174 @@
+import datetime
+import json
+import threading
+import time
+import uuid
+import zlib
+from functools import lru_cache
+
+import redis
+from decouple import config
+
+from src.redis_utils import get_redis
+
+
+_MISSING = object()
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"Can't cache a {type(value).__name__}")
+
+
+def _decode_value(obj):
+    if '$datetime' in obj:
+        return datetime.datetime.fromisoformat(obj['$datetime'])
+    if '$date' in obj:
+        return datetime.date.fromisoformat(obj['$date'])
+    return obj
+
+
+# Releases the recompute lock only if it is still held by the caller that took it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ReadThroughCache:
+    # Values are stored as zlib-compressed JSON under `{prefix}.cache:{name}` with a TTL. On a miss only the
+    # caller that gets the recompute lock runs the loader; the others wait for its result instead of all hitting
+    # Postgres at once. Writers call invalidate() after changing the underlying data; a value loaded concurrently with
+    # an invalidation can still be stored, which the TTL bounds. If Redis is unavailable, the loader is called directly.
+    def __init__(self, client, prefix, ttl=60, lock_timeout=10.0, wait_timeout=5.0):
+        self.r = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self._release_lock = self.r.register_script(RELEASE_LOCK_SCRIPT)
+
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.errors = 0
+
+    def _key(self, name):
+        return f"{self.prefix}.cache:{name}"
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # JSON rather than pickle: the Redis is shared, and unpickling what anybody wrote there would run their code.
+    # Values are rows of plain types (tuples come back as lists); dates and datetimes are tagged ISO strings.
+    @staticmethod
+    def dumps(value):
+        return zlib.compress(json.dumps(value, default=_encode_value, separators=(',', ':')).encode())
+
+    @staticmethod
+    def loads(data):
+        return json.loads(zlib.decompress(data), object_hook=_decode_value)
+
+    def _decode(self, data):
+        # a value that doesn't decode (corrupt, or written by something else) counts as missing
+        if data is None:
+            return _MISSING
+        try:
+            return self.loads(data)
+        except (zlib.error, ValueError, TypeError, UnicodeDecodeError):
+            self._count('errors')
+            return _MISSING
+
+    def get(self, name, loader, ttl=None):
+        key = self._key(name)
+        try:
+            data = self.r.get(key)
+        except redis.RedisError:
+            self._count('errors')
+            return loader()
+
+        value = self._decode(data)
+        if value is not _MISSING:
+            self._count('hits')
+            return value
+        self._count('misses')
+
+        lock_key = f"{key}:lock"
+        token = uuid.uuid4().hex
+        try:
+            locked = self.r.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000))
+        except redis.RedisError:
+            self._count('errors')
+            return loader()
+
+        if not locked:
+            # somebody else is recomputing the value: wait for it, fall back to loading ourselves
+            self._count('waits')
+            deadline = time.monotonic() + self.wait_timeout
+            delay = 0.005
+            while time.monotonic() < deadline:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+                try:
+                    data = self.r.get(key)
+                except redis.RedisError:
+                    self._count('errors')
+                    break
+                value = self._decode(data)
+                if value is not _MISSING:
+                    return value
+            return loader()
+
+        try:
+            value = loader()
+            try:
+                self.r.set(key, self.dumps(value), ex=ttl or self.ttl)
+            except (redis.RedisError, TypeError):
+                self._count('errors')
+            return value
+        finally:
+            try:
+                self._release_lock(keys=[lock_key], args=[token])
+            except redis.RedisError:
+                # the lock expires after lock_timeout
+                self._count('errors')
+
+    def invalidate(self, *names):
+        if not names:
+            return
+        try:
+            self.r.delete(*(self._key(name) for name in names))
+        except redis.RedisError:
+            self._count('errors')
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'waits': self.waits,
+                'errors': self.errors,
+            }
+
+
+@lru_cache(maxsize=None)
+def get_cache():
+    # shares the Redis client of TrendingTopics
+    return ReadThroughCache(get_redis(), prefix=config('SCHEMA_NAME'), ttl=config('CACHE_TTL', default=60, cast=int))
+
+
+def hourly_activity_name(schema, day):
+    return f"{schema}.user_activity_datamart:{day.isoformat()}"
+
+
+def invalidate_hourly_activity(schema, days):
+    get_cache().invalidate(*(hourly_activity_name(schema, day) for day in set(days)))
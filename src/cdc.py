@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import datetime
+import json
+import traceback
+from collections import Counter
+
+import psycopg2
+from decouple import config
+
+from src.analytics import rebuild_daily_days
+from src.cache import invalidate_hourly_activity
+from src.utils import connect, pooled, bump_activity_counters, ensure_schema
+
+
+# Change data capture for the marts: statement-level triggers on user_activity, diary_records and payments publish
+# what a statement changed, aggregated over its transition tables, on the `<schema>_mart_changes` channel when the
+# transaction commits. MartChangeConsumer LISTENs on it, coalesces the events of a short window and applies them in
+# one transaction: activity counter deltas per (type, date, hour) to user_activity_datamart, touched days recomputed
+# in daily_analytics_data_mart. Payloads are JSON, {"k": kind, "n": nonce, "c": [change, ...]}:
+#   activity  [activity_type, "YYYY-MM-DD", hour, delta]
+#   daily     "YYYY-MM-DD"
+# Postgres folds identical notifications of one transaction into one, so every payload carries a unique nonce from
+# the <schema>.mart_changes_seq sequence (the consumer ignores it); two statements bumping the same slice by the same
+# delta would otherwise be counted once.
+# Notifications sent while no consumer listens are lost; reconcile_actions_datamart and populate_data_mart repair that.
+# Bulk loads that rebuild the marts themselves skip the triggers with SET LOCAL mart_cdc.disabled = on.
+
+# pg_notify payloads are limited to 8000 bytes
+MAX_PAYLOAD = 7000
+
+
+def channel_name(schema):
+    return f"{schema}_mart_changes"
+
+
+def _changes_function(schema, table, changes_sql, kind):
+    # a trigger function publishing changes_sql(transition table, sign) for INSERT, DELETE and UPDATE statements
+    return f"""
+    CREATE OR REPLACE FUNCTION {schema}.{table}_mart_changes() RETURNS trigger AS $$
+    BEGIN
+        IF current_setting('mart_cdc.disabled', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP = 'INSERT' THEN
+            PERFORM {schema}.publish_mart_changes('{kind}', ({changes_sql("SELECT *, 1 AS sign FROM new_rows")}));
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM {schema}.publish_mart_changes('{kind}', ({changes_sql("SELECT *, -1 AS sign FROM old_rows")}));
+        ELSE
+            PERFORM {schema}.publish_mart_changes('{kind}', ({changes_sql(
+                "SELECT *, 1 AS sign FROM new_rows UNION ALL SELECT *, -1 AS sign FROM old_rows")}));
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    """
+
+
+def _activity_changes(rows):
+    return f"""
+    SELECT jsonb_agg(jsonb_build_array(activity_type, day, hour, delta)) FROM (
+        SELECT activity_type, date(activity_date) AS day, EXTRACT(HOUR FROM activity_date)::int AS hour,
+               SUM(sign) AS delta
+        FROM ({rows}) r
+        GROUP BY 1, 2, 3
+        HAVING SUM(sign) <> 0
+    ) c
+    """
+
+
+def _days_changes(column):
+    def changes(rows):
+        return f"SELECT jsonb_agg(DISTINCT date({column})) FROM ({rows}) r"
+    return changes
+
+
+# table -> (kind, aggregation of its transition tables)
+CDC_TABLES = {
+    'user_activity': ('activity', _activity_changes),
+    'diary_records': ('daily', _days_changes('created_on')),
+    'payments': ('daily', _days_changes('payment_date')),
+}
+
+
+def ensure_mart_cdc(schema: str):
+    channel = channel_name(schema)
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {schema}.mart_changes_seq")
+            cursor.execute(
+                f"""
+                CREATE OR REPLACE FUNCTION {schema}.publish_mart_changes(kind TEXT, changes JSONB) RETURNS void AS $$
+                DECLARE
+                    chunk JSONB := '[]';
+                    change JSONB;
+                BEGIN
+                    FOR change IN SELECT jsonb_array_elements(changes) LOOP
+                        chunk := chunk || jsonb_build_array(change);
+                        IF length(chunk::text) > {MAX_PAYLOAD} THEN
+                            PERFORM pg_notify('{channel}', jsonb_build_object(
+                                'k', kind, 'n', nextval('{schema}.mart_changes_seq'), 'c', chunk)::text);
+                            chunk := '[]';
+                        END IF;
+                    END LOOP;
+                    IF jsonb_array_length(chunk) > 0 THEN
+                        PERFORM pg_notify('{channel}', jsonb_build_object(
+                            'k', kind, 'n', nextval('{schema}.mart_changes_seq'), 'c', chunk)::text);
+                    END IF;
+                END
+                $$ LANGUAGE plpgsql;
+                """
+            )
+            for table, (kind, changes_sql) in CDC_TABLES.items():
+                cursor.execute(_changes_function(schema, table, changes_sql, kind))
+                # transition tables allow a single event per trigger
+                for event, referencing in (('INSERT', 'NEW TABLE AS new_rows'),
+                                           ('DELETE', 'OLD TABLE AS old_rows'),
+                                           ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows')):
+                    trigger = f"{table}_mart_changes_{event.lower()}"
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {schema}.{table}")
+                    cursor.execute(
+                        f"""CREATE TRIGGER {trigger} AFTER {event} ON {schema}.{table}
+                        REFERENCING {referencing} FOR EACH STATEMENT
+                        EXECUTE FUNCTION {schema}.{table}_mart_changes()""")
+            conn.commit()
+
+
+def drop_mart_cdc(schema: str):
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            for table in CDC_TABLES:
+                for event in ('insert', 'delete', 'update'):
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {table}_mart_changes_{event} ON {schema}.{table}")
+                cursor.execute(f"DROP FUNCTION IF EXISTS {schema}.{table}_mart_changes()")
+            cursor.execute(f"DROP FUNCTION IF EXISTS {schema}.publish_mart_changes(TEXT, JSONB)")
+            cursor.execute(f"DROP SEQUENCE IF EXISTS {schema}.mart_changes_seq")
+            conn.commit()
+
+
+class ChangeBatch:
+    def __init__(self):
+        self.activity = Counter()
+        self.days = set()
+        self.events = 0
+        self.malformed = 0
+
+    def add(self, payload):
+        # a payload that doesn't parse is skipped as a whole (and counted), it never breaks the batch
+        try:
+            event = json.loads(payload)
+            if event['k'] == 'activity':
+                activity = [((activity_type, datetime.date.fromisoformat(day), int(hour)), int(delta))
+                            for activity_type, day, hour, delta in event['c']]
+                days = []
+            else:
+                activity = []
+                days = [datetime.date.fromisoformat(day) for day in event['c']]
+        except (ValueError, KeyError, TypeError) as error:
+            self.malformed += 1
+            print(f"Skipped a malformed change notification ({error!r}): {payload[:200]}")
+            return
+
+        self.events += 1
+        for key, delta in activity:
+            self.activity[key] += delta
+        self.days.update(days)
+
+    def __bool__(self):
+        return self.events > 0
+
+
+class MartChangeConsumer:
+    # Listens on a dedicated autocommit connection (pooled connections run transactions and would only see the
+    # notifications between them). Batches are applied on a pooled connection in the default executor.
+    def __init__(self, schema, window=1.0, max_attempts=3):
+        self.schema = schema
+        self.window = window
+        self.max_attempts = max_attempts
+
+        self.applied_batches = 0
+        self.applied_events = 0
+        self.failed_batches = 0
+        self.malformed_events = 0
+
+    def apply(self, batch):
+        activity = {key: delta for key, delta in batch.activity.items() if delta}
+        with pooled() as conn:
+            with conn.cursor() as cursor:
+                if activity:
+                    bump_activity_counters(cursor, self.schema, activity)
+                if batch.days:
+                    rebuild_daily_days(cursor, self.schema, batch.days)
+            conn.commit()
+
+        if activity:
+            invalidate_hourly_activity(self.schema, [day for _, day, _ in activity])
+
+    async def _apply(self, batch):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await loop.run_in_executor(None, self.apply, batch)
+                self.applied_batches += 1
+                self.applied_events += batch.events
+                return
+            except Exception:
+                traceback.print_exc()
+                if attempt == self.max_attempts:
+                    self.failed_batches += 1
+                    print("Mart changes dropped, run main.py --reconcile-days and populate_data_mart to repair.")
+                else:
+                    await asyncio.sleep(self.window * attempt)
+
+    async def _listen(self, stop):
+        loop = asyncio.get_running_loop()
+        payloads = asyncio.Queue()
+        conn = connect()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {channel_name(self.schema)}")
+
+        def on_readable():
+            try:
+                conn.poll()
+            except psycopg2.Error as error:
+                payloads.put_nowait(error)
+                return
+            while conn.notifies:
+                payloads.put_nowait(conn.notifies.pop(0).payload)
+
+        loop.add_reader(conn.fileno(), on_readable)
+        try:
+            while not stop.is_set():
+                try:
+                    payload = await asyncio.wait_for(payloads.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    continue
+
+                # coalesce everything that arrives within the window into one batch
+                batch = ChangeBatch()
+                deadline = loop.time() + self.window
+                while True:
+                    if isinstance(payload, Exception):
+                        # the changes received before the connection broke are applied before reconnecting
+                        if batch:
+                            await self._apply(batch)
+                        self.malformed_events += batch.malformed
+                        raise payload
+                    batch.add(payload)
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        payload = await asyncio.wait_for(payloads.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+
+                self.malformed_events += batch.malformed
+                if batch:
+                    await self._apply(batch)
+        finally:
+            loop.remove_reader(conn.fileno())
+            conn.close()
+
+    async def run(self, stop=None):
+        # runs until `stop` (an asyncio.Event) is set, reconnecting if the listening connection is lost
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            try:
+                await self._listen(stop)
+            except psycopg2.Error:
+                traceback.print_exc()
+                print("Lost the change notifications connection, reconnecting.")
+                await asyncio.sleep(1.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keep the marts fresh from change notifications")
+    parser.add_argument('--install', action='store_true', help="create the triggers before listening")
+    parser.add_argument('--uninstall', action='store_true', help="drop the triggers and exit")
+    parser.add_argument('--window', type=float, default=config('MART_CDC_WINDOW', default=1.0, cast=float),
+                        help="seconds of changes coalesced into one batch (MART_CDC_WINDOW)")
+    args = parser.parse_args()
+
+    schema = ensure_schema(drop_if_exists=False)
+    if args.uninstall:
+        drop_mart_cdc(schema)
+    else:
+        if args.install:
+            ensure_mart_cdc(schema)
+        consumer = MartChangeConsumer(schema, window=args.window)
+        try:
+            asyncio.run(consumer.run())
+        except KeyboardInterrupt:
+            pass
+        print(f"Applied {consumer.applied_events} change events in {consumer.applied_batches} batches, "
+              f"skipped {consumer.malformed_events} malformed ones.")
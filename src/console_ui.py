@@ -1,70 +1,109 @@
-import bcrypt
-import psycopg2
-from decouple import config
-from faker import Faker
-import random
 import datetime
 from dataclasses import dataclass
 
-from src.utils import connect
-from src.redis_utils import TrendingTopics
+from src.utils import pooled, bump_activity_counters
+from src.redis_utils import get_trending_topics
+from src.ingest import create_pipeline
+from src.cache import get_cache, hourly_activity_name, invalidate_hourly_activity
 
 
 @dataclass
 class User:
+    __slots__ = ('id', 'email', 'name')
+
     id: int
     email: str
     name: str
 
 
-def interactive_login(conn, schema):
+LOGIN_PAGE_SIZE = 10
+
+
+def find_users(conn, schema, prefix='', after=None, limit=LOGIN_PAGE_SIZE):
+    # Users whose email or name starts with `prefix` (case-insensitive): the email matches ordered by email, then the
+    # users matching by name only, ordered by name. Each part is a LIMITed scan in the order of its index and pages
+    # are read by keyset, so the cost doesn't depend on the page number or the total number of users. `after` is the
+    # key returned with the previous page. Returns (users, key of the next page or None).
+    pattern = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    params = {'pattern': pattern, 'limit': limit + 1}
+    part, after_key, after_id = after or (0, None, None)
+    params['after_key'], params['after_id'] = after_key, after_id
+
+    parts = []
+    if part == 0:
+        keyset = """AND (lower(email) COLLATE "C", user_id) > (%(after_key)s, %(after_id)s)""" if after else ''
+        parts.append(
+            f"""(SELECT 0 AS part, user_id, email, name, lower(email) COLLATE "C" AS sort_key FROM {schema}.users
+            WHERE lower(email) COLLATE "C" LIKE %(pattern)s {keyset}
+            ORDER BY lower(email) COLLATE "C", user_id LIMIT %(limit)s)""")
+    if prefix:
+        # without a prefix everybody already matches by email
+        keyset = """AND (lower(name) COLLATE "C", user_id) > (%(after_key)s, %(after_id)s)""" if part == 1 else ''
+        parts.append(
+            f"""(SELECT 1 AS part, user_id, email, name, lower(name) COLLATE "C" AS sort_key FROM {schema}.users
+            WHERE lower(name) COLLATE "C" LIKE %(pattern)s AND lower(email) COLLATE "C" NOT LIKE %(pattern)s {keyset}
+            ORDER BY lower(name) COLLATE "C", user_id LIMIT %(limit)s)""")
+
     with conn.cursor() as cursor:
-        cursor.execute(f"select user_id, email, name from {schema}.users order by email")
-        users = [User(*u) for u in cursor.fetchall()]
+        cursor.execute(
+            f"""{' UNION ALL '.join(parts)}
+            ORDER BY part, sort_key, user_id LIMIT %(limit)s""",
+            params)
+        rows = cursor.fetchall()
 
-    for i, u in enumerate(users):
-        print(f"{i}: {u.email}\t{u.name}")
+    users = [User(user_id, email, name) for _, user_id, email, name, _ in rows[:limit]]
+    if len(rows) > limit:
+        part, user_id, _, _, sort_key = rows[limit - 1]
+        return users, (part, sort_key, user_id)
+    return users, None
 
-    u_idx = int(input("To login, type user number: "))
 
-    # insert record to user_activity table
-    with conn.cursor() as cursor:
-        dt = datetime.datetime.now()
-        cursor.execute(f"INSERT INTO {schema}.user_activity (user_id, activity_type, activity_date) VALUES (%s, %s, %s)",
-                       (users[u_idx].id, 'login', dt))
-        recalc_actions_datamart(conn, schema, users[u_idx].id, dt)
+def interactive_login(conn, schema, pipeline):
+    prefix = input("To login, type the beginning of your email or name (empty to list everybody): ").strip()
+    after = None
 
+    while True:
+        users, next_key = find_users(conn, schema, prefix, after)
         conn.commit()
 
-    return users[u_idx]
+        if not users:
+            prefix = input("Nobody found, try again: ").strip()
+            after = None
+            continue
 
+        for i, u in enumerate(users):
+            print(f"{i}: {u.email}\t{u.name}")
 
-def recalc_actions_datamart(conn, schema, user_id, date):
-    # select all records from user_activity table for the user_id and date
-    # insert records to actions_datamart table with corresponding aggregations
+        hint = ", 'n' for more" if next_key else ''
+        answer = input(f"To login, type user number{hint} or a new search ('/' first to search for digits): ").strip()
+        if answer.isdigit() and int(answer) < len(users):
+            user = users[int(answer)]
+            break
+        if answer == 'n' and next_key:
+            after = next_key
+        else:
+            prefix, after = answer.removeprefix('/'), None
 
-    date_str = date.strftime('%Y-%m-%d')
+    # the login goes to user_activity (and the datamart) through the ingestion pipeline
+    pipeline.record_activity(user.id, 'login')
 
+    return user
+
+
+def recalc_actions_datamart(conn, schema, *, activity_type, date, count=1):
+    # bump the counter of the (activity type, day, hour) slice the new activity falls into.
+    # The cost doesn't depend on how many events the day already has; drift (e.g. from activity
+    # inserted without going through here) is repaired by reconcile_actions_datamart. The arguments are keyword-only,
+    # so calls of the old (conn, schema, user_id, date) signature fail instead of counting a user id as a type.
     with conn.cursor() as cursor:
-        cursor.execute(
-            f"""DELETE FROM {schema}.user_activity_datamart WHERE date(activity_date) = date(%s)""",
-            (date_str, ))
+        bump_activity_counters(cursor, schema, {(activity_type, date.date(), date.hour): count})
 
-        cursor.execute(
-            f"""
-            INSERT INTO {schema}.user_activity_datamart (activity_type, activity_date, activity_hour, activity_count)
-            (SELECT activity_type, date(activity_date), EXTRACT(HOUR FROM activity_date) as activity_hour, COUNT(*) as activity_count
-            FROM {schema}.user_activity
-            WHERE date(activity_date) = date(%s)
-            GROUP BY activity_type, date(activity_date), EXTRACT(HOUR FROM activity_date)
-            ORDER BY date(activity_date), activity_hour)
-            """
-            , (date_str,))
+    invalidate_hourly_activity(schema, [date.date()])
 
 
-def add_diary_records(conn, schema, user):
+def add_diary_records(conn, schema, user, pipeline):
 
-    trending_monitor = TrendingTopics(host=config('REDIS_HOST'), port=config('REDIS_PORT'), password=config('REDIS_PASSWORD'))
+    trending_monitor = get_trending_topics()
 
     diary_id = None
     text = '<start>'
@@ -80,57 +119,62 @@ def add_diary_records(conn, schema, user):
             print("Please, three words or more!")
             continue
 
-        trending_monitor.update_trending(text)
-
-        with conn.cursor() as cursor:
-            if diary_id is None:
+        if diary_id is None:
+            with conn.cursor() as cursor:
                 cursor.execute(f"SELECT diary_id from {schema}.diaries where user_id = %s", (user.id,))
-                diary_id = cursor.fetchone()
+                diary_id = cursor.fetchone()[0]
+            conn.commit()
 
-            title = ' '.join(words[:2])
-            tags = ','.join(words[:2])
+        trending_monitor.update_trending(text)
 
-            cursor.execute(
-                f"INSERT INTO {schema}.diary_records (diary_id, title, created_on, text, tags) VALUES (%s, %s, %s, %s, %s)",
-                (diary_id, title, datetime.datetime.now(), text, tags))
+        title = ' '.join(words[:2])
+        tags = ','.join(words[:2])
 
-            dt = datetime.datetime.now()
+        # the record and its activity are written by the pipeline's background writer
+        dt = datetime.datetime.now()
+        pipeline.record_diary(diary_id, title, text, tags, dt)
+        pipeline.record_activity(user.id, 'diary_record', dt)
 
-            # insert record to user_activity table
-            cursor.execute(f"INSERT INTO {schema}.user_activity (user_id, activity_type, activity_date) VALUES (%s, %s, %s)",
-                            (user.id, 'diary_record', dt))
+        trending = trending_monitor.get_trending()
+        if trending:
+            print("\nTrending now:\n")
+            for i, w in enumerate(trending):
+                print(f"{i}. {w.decode()}")
+        else:
+            print("It's calm in the whole world now!")
 
-            recalc_actions_datamart(conn, schema, user.id, dt)
+        print()
 
-            conn.commit()
 
-            trending = trending_monitor.get_trending()
-            if trending:
-                print("\nTrending now:\n")
-                for i, w in enumerate(trending):
-                    print(f"{i}. {w.decode()}")
-            else:
-                print("It's calm in the whole world now!")
+def hourly_activity(conn, schema, day):
+    def load():
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""SELECT activity_hour, activity_type, activity_count FROM {schema}.user_activity_datamart
+                WHERE activity_date = %s
+                ORDER BY activity_hour, activity_type""",
+                (day, ))
+            return cursor.fetchall()
 
-            print()
+    # cached until the counters of the day change (see invalidate_hourly_activity)
+    return get_cache().get(hourly_activity_name(schema, day), load)
 
-def start_interaction(schema):
-    conn = connect()
 
-    user = interactive_login(conn, schema)
-    print(f"Logged in as {user.name}")
+def start_interaction(schema):
+    pipeline = create_pipeline(schema).start()
 
-    add_diary_records(conn, schema, user)
+    with pooled() as conn:
+        try:
+            user = interactive_login(conn, schema, pipeline)
+            print(f"Logged in as {user.name}")
 
-    # select and print hourly activity of all users from the user_activity_datamart table for the current day
-    # grouped by hour and activity type
-    with conn.cursor() as cursor:
-        cursor.execute(
-            f"""SELECT activity_hour, activity_type, activity_count FROM {schema}.user_activity_datamart
-            WHERE date(activity_date) = date(%s)
-            ORDER BY activity_hour, activity_type""",
-            (datetime.datetime.now().strftime('%Y-%m-%d'), ))
+            add_diary_records(conn, schema, user, pipeline)
+        finally:
+            # wait for the pending events, so that the report below includes this session
+            pipeline.stop()
 
+        # select and print hourly activity of all users from the user_activity_datamart table for the current day
+        # grouped by hour and activity type
         print("\nHourly activity:\nhour\ttype\tcount\n")
-        for row in cursor.fetchall():
+        for row in hourly_activity(conn, schema, datetime.date.today()):
             print(f"{row[0]}\t{row[1]}\t{row[2]}")
@@ -0,0 +1,186 @@
+import argparse
+import datetime
+import json
+import time
+import traceback
+from collections import Counter, defaultdict
+
+from decouple import config
+from psycopg2.extras import execute_values
+
+from src.analytics import create_daily_analytics_data_mart, populate_data_mart
+from src.cache import invalidate_hourly_activity
+from src.redis_utils import get_trending_topics, get_active_users
+from src.utils import pooled, bump_activity_counters, ensure_schema
+
+
+# Bulk import of diary entries, e.g. a JSONL export of another service, one entry per line:
+#   {"user_id": 42, "text": "...", "title": "...", "tags": ["a", "b"] or "a,b", "created_on": "2024-05-01T10:00:00"}
+# Only user_id and text are required. Every batch is one transaction: the diary records and their 'diary_record'
+# activity go in with one multi-row INSERT each and the activity counters are bumped with one upsert. The daily mart
+# is refreshed once at the end, from the watermarks, and the trending topics get the recent entries in one
+# pipelined call.
+#
+#   python -m src.diary_import entries.jsonl --batch-size 5000
+
+
+class DiaryIds:
+    # user_id -> diary_id, resolved for a whole batch in one query; users without a diary get one
+    def __init__(self, schema):
+        self.schema = schema
+        self.ids = {}
+        self.unknown_users = set()
+
+    def resolve(self, cursor, user_ids):
+        missing = sorted(set(user_ids) - self.ids.keys() - self.unknown_users)
+        if missing:
+            cursor.execute(f"SELECT user_id, diary_id FROM {self.schema}.diaries WHERE user_id = ANY(%s)", (missing, ))
+            self.ids.update(cursor.fetchall())
+            missing = [user_id for user_id in missing if user_id not in self.ids]
+        if missing:
+            # a diary created concurrently by somebody else is picked up by the second SELECT
+            cursor.execute(
+                f"""INSERT INTO {self.schema}.diaries (user_id)
+                SELECT user_id FROM {self.schema}.users WHERE user_id = ANY(%s)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id, diary_id""",
+                (missing, ))
+            self.ids.update(cursor.fetchall())
+            missing = [user_id for user_id in missing if user_id not in self.ids]
+        if missing:
+            cursor.execute(f"SELECT user_id, diary_id FROM {self.schema}.diaries WHERE user_id = ANY(%s)", (missing, ))
+            self.ids.update(cursor.fetchall())
+            self.unknown_users.update(user_id for user_id in missing if user_id not in self.ids)
+        return self.ids
+
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _normalize(entry, now):
+    # -> (user_id, title, created_on, text, tags) as stored in diary_records; raises ValueError for malformed entries
+    text = entry['text']
+    if not isinstance(text, str) or not text:
+        raise ValueError("text must be a non-empty string")
+    created_on = entry.get('created_on') or now
+    if isinstance(created_on, str):
+        created_on = datetime.datetime.fromisoformat(created_on)
+    elif not isinstance(created_on, datetime.datetime):
+        raise ValueError("created_on must be an ISO timestamp")
+    if created_on.tzinfo is not None:
+        # the columns are TIMESTAMP in local time, like the rows the console writes
+        created_on = created_on.astimezone().replace(tzinfo=None)
+    tags = entry.get('tags') or ''
+    if not isinstance(tags, str):
+        tags = ','.join(tags)
+    # same default title as the console
+    title = entry.get('title') or ' '.join(text.split(' ')[:2])
+    if not isinstance(title, str):
+        raise ValueError("title must be a string")
+    return int(entry['user_id']), title[:255], created_on, text, tags
+
+
+def _batches(entries, batch_size, stats):
+    now = datetime.datetime.now()
+    batch = []
+    for entry in entries:
+        try:
+            batch.append(_normalize(entry, now))
+        except (KeyError, TypeError, ValueError):
+            stats['invalid'] += 1
+            continue
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _import_batch(schema, batch, diary_ids, update_marts):
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            ids = diary_ids.resolve(cursor, [entry[0] for entry in batch])
+            entries = [entry for entry in batch if entry[0] in ids]
+            if entries:
+                execute_values(
+                    cursor,
+                    f"INSERT INTO {schema}.diary_records (diary_id, title, created_on, text, tags) VALUES %s",
+                    [(ids[user_id], title, created_on, text, tags) for user_id, title, created_on, text, tags in entries],
+                    page_size=len(entries))
+                execute_values(
+                    cursor,
+                    f"INSERT INTO {schema}.user_activity (user_id, activity_type, activity_date) VALUES %s",
+                    [(user_id, 'diary_record', created_on) for user_id, _, created_on, _, _ in entries],
+                    page_size=len(entries))
+                if update_marts:
+                    counts = Counter(('diary_record', created_on.date(), created_on.hour)
+                                     for _, _, created_on, _, _ in entries)
+                    bump_activity_counters(cursor, schema, counts)
+        conn.commit()
+    return entries
+
+
+def import_diary_entries(schema: str, entries, batch_size: int = 5000, trending=None):
+    # Imports an iterable of entry dicts (see above). Entries of users that don't exist and malformed ones are
+    # skipped and counted. Returns the counts. `trending` is the TrendingTopics to update, the shared one by default.
+    started = time.perf_counter()
+    stats = Counter()
+    diary_ids = DiaryIds(schema)
+    # with change data capture on, the mart change consumer (src/cdc.py) maintains the marts
+    update_marts = not config('MART_CDC', default=False, cast=bool)
+
+    trending = trending or get_trending_topics()
+    window_start = time.time() - trending.expire_time
+    bucket_counts = defaultdict(Counter)
+
+    for batch in _batches(entries, batch_size, stats):
+        imported = _import_batch(schema, batch, diary_ids, update_marts)
+        stats['imported'] += len(imported)
+        stats['unknown_user'] += len(batch) - len(imported)
+        stats['batches'] += 1
+
+        # the batch is committed, a failing cache or counter update must not abort the import
+        try:
+            if update_marts:
+                invalidate_hourly_activity(schema, {created_on.date() for _, _, created_on, _, _ in imported})
+            get_active_users(schema).add((user_id, created_on) for user_id, _, created_on, _, _ in imported)
+        except Exception:
+            traceback.print_exc()
+
+        # only entries inside the trending window count, older ones would land in expired buckets. Words are
+        # counted per batch and sent to Redis together at the end.
+        texts = defaultdict(list)
+        for _, _, created_on, text, _ in imported:
+            timestamp = created_on.timestamp()
+            if timestamp >= window_start:
+                texts[int(timestamp // trending.bucket_size)].append(text)
+        for bucket, bucket_texts in texts.items():
+            bucket_counts[bucket].update(trending.tokenizer.count_many(bucket_texts))
+
+    if bucket_counts:
+        trending.add_bucket_counts(bucket_counts)
+        trending.invalidate()
+
+    if update_marts and stats['imported']:
+        populate_data_mart(schema)
+
+    elapsed = time.perf_counter() - started
+    print(f"Imported {stats['imported']} diary entries in {stats['batches']} batches, {elapsed:.1f}s "
+          f"({stats['imported'] / elapsed if elapsed else 0:,.0f} entries/s); skipped {stats['unknown_user']} "
+          f"of unknown users and {stats['invalid']} malformed.")
+    return dict(stats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import diary entries from a JSONL file")
+    parser.add_argument('path')
+    parser.add_argument('--batch-size', type=int, default=5000, help="entries per transaction")
+    args = parser.parse_args()
+
+    schema = ensure_schema(drop_if_exists=False)
+    create_daily_analytics_data_mart(schema)
+    import_diary_entries(schema, read_jsonl(args.path), batch_size=args.batch_size)
@@ -0,0 +1,398 @@
+import datetime
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+
+import redis
+from decouple import config
+from psycopg2.extras import execute_values
+
+from src.utils import pooled, bump_activity_counters
+from src.redis_utils import get_redis, get_active_users
+from src.cache import invalidate_hourly_activity
+
+
+# Write-behind ingestion of activity and diary events: the interactive code only enqueues an event and returns,
+# a background writer flushes the queue in batches (multi-row INSERTs, one transaction and one counter upsert per
+# batch). Events are dicts:
+#   {'kind': 'activity', 'user_id', 'activity_type', 'activity_date'}
+#   {'kind': 'diary', 'diary_id', 'title', 'created_on', 'text', 'tags'}
+
+
+class QueueFull(Exception):
+    pass
+
+
+def activity_event(user_id, activity_type, activity_date=None):
+    return {'kind': 'activity', 'user_id': user_id, 'activity_type': activity_type,
+            'activity_date': activity_date or datetime.datetime.now()}
+
+
+def diary_event(diary_id, title, text, tags, created_on=None):
+    return {'kind': 'diary', 'diary_id': diary_id, 'title': title, 'text': text, 'tags': tags,
+            'created_on': created_on or datetime.datetime.now()}
+
+
+class MemoryEventQueue:
+    # In-process bounded queue. Events that were not flushed yet are lost if the process dies.
+    def __init__(self, maxsize=10000):
+        self.queue = queue.Queue(maxsize)
+        self.dead_letters = 0
+
+    def put(self, event, timeout=None):
+        # blocks while the queue is full (backpressure), up to `timeout` seconds
+        try:
+            self.queue.put(event, timeout=timeout)
+        except queue.Full:
+            raise QueueFull(f"Event queue is full ({self.queue.maxsize} events)")
+
+    def get_batch(self, max_size, max_wait):
+        # waits up to max_wait for the first event, then takes whatever is already queued up to max_size
+        try:
+            batch = [self.queue.get(timeout=max_wait)]
+        except queue.Empty:
+            return [], None
+        while len(batch) < max_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch, None
+
+    def ack(self, ids):
+        pass
+
+    def dead_letter(self, event, ids, error):
+        self.dead_letters += 1
+        print(f"Dropped an event that can't be written ({error}): {event}")
+
+    def drained(self):
+        return self.queue.empty()
+
+    def __len__(self):
+        return self.queue.qsize()
+
+
+def _encode(event):
+    return json.dumps({key: value.isoformat() if isinstance(value, datetime.datetime) else value
+                       for key, value in event.items()}, separators=(',', ':'))
+
+
+def _decode(data):
+    event = json.loads(data)
+    for key in ('activity_date', 'created_on'):
+        if key in event:
+            event[key] = datetime.datetime.fromisoformat(event[key])
+    return event
+
+
+def _stream_id(entry_id):
+    # stream ids are b'<ms>-<seq>'
+    ms, seq = entry_id.split(b'-')
+    return int(ms), int(seq)
+
+
+class RedisStreamEventQueue:
+    # Durable queue on a Redis stream, shared by any number of producer and writer processes. Every writer reads
+    # the consumer group under its own consumer name, and entries are acknowledged only after their batch is
+    # committed. Entries a writer read but never acknowledged (it crashed) are claimed by another writer once they
+    # have been idle for `claim_idle` seconds (at-least-once delivery). Entries delivered `max_deliveries` times, or
+    # that can't be decoded or written, are moved to the `<key>:dead` stream and acknowledged.
+    def __init__(self, client, key, group='writers', consumer='writer-1', maxlen=100000,
+                 claim_idle=60.0, claim_interval=10.0, max_deliveries=5):
+        self.r = client
+        self.key = key
+        self.dead_key = f"{key}:dead"
+        self.group = group
+        self.consumer = consumer
+        self.maxlen = maxlen
+        self.claim_idle = claim_idle
+        self.claim_interval = claim_interval
+        self.max_deliveries = max_deliveries
+        self.dead_letters = 0
+
+        self._next_claim = 0.0
+        self._claim_cursor = '0-0'
+        self._last_put_id = None
+        self._last_read_id = None
+
+        try:
+            self.r.xgroup_create(self.key, self.group, id='0', mkstream=True)
+        except redis.ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+
+    def put(self, event, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.r.xlen(self.key) >= self.maxlen:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise QueueFull(f"Event stream {self.key} is full ({self.maxlen} events)")
+            time.sleep(0.01)
+        self._last_put_id = _stream_id(self.r.xadd(self.key, {'e': _encode(event)}))
+
+    def _decode_entries(self, entries):
+        batch, ids = [], []
+        for entry_id, fields in entries:
+            try:
+                batch.append(_decode(fields[b'e']))
+            except (KeyError, TypeError, ValueError) as error:
+                self.dead_letter(fields, [entry_id], error)
+                continue
+            ids.append(entry_id)
+        return batch, ids
+
+    def _claim_stale(self, max_size):
+        # entries of writers that died before acknowledging them
+        response = self.r.xautoclaim(self.key, self.group, self.consumer, int(self.claim_idle * 1000),
+                                     start_id=self._claim_cursor, count=max_size)
+        self._claim_cursor = response[0]
+        # entries deleted since they were read come back without fields
+        entries = [(entry_id, fields) for entry_id, fields in response[1] if fields]
+        if self._claim_cursor not in (b'0-0', '0-0') or len(entries) >= max_size:
+            # more to claim, keep going on the next call
+            self._next_claim = 0.0
+        if not entries:
+            return entries
+
+        pending = self.r.xpending_range(self.key, self.group, min=entries[0][0], max=entries[-1][0],
+                                        count=len(entries) + max_size, consumername=self.consumer)
+        deliveries = {item['message_id']: item['times_delivered'] for item in pending}
+        claimed = []
+        for entry_id, fields in entries:
+            if deliveries.get(entry_id, 0) > self.max_deliveries:
+                self.dead_letter(fields, [entry_id], f"delivered {deliveries[entry_id]} times")
+            else:
+                claimed.append((entry_id, fields))
+        return claimed
+
+    def get_batch(self, max_size, max_wait):
+        if time.monotonic() >= self._next_claim:
+            self._next_claim = time.monotonic() + self.claim_interval
+            entries = self._claim_stale(max_size)
+            if entries:
+                return self._decode_entries(entries)
+
+        response = self.r.xreadgroup(self.group, self.consumer, {self.key: '>'}, count=max_size,
+                                     block=int(max_wait * 1000))
+        entries = response[0][1] if response else []
+        if entries:
+            self._last_read_id = _stream_id(entries[-1][0])
+        return self._decode_entries(entries)
+
+    def ack(self, ids):
+        if ids:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.xack(self.key, self.group, *ids)
+            pipe.xdel(self.key, *ids)
+            pipe.execute()
+
+    def dead_letter(self, event, ids, error):
+        self.dead_letters += len(ids)
+        # a decoded event, or the raw fields of an entry that couldn't be decoded
+        data = {b'e': _encode(event)} if 'kind' in event else event
+        pipe = self.r.pipeline(transaction=False)
+        pipe.xadd(self.dead_key, {**data, b'error': str(error)}, maxlen=self.maxlen, approximate=True)
+        pipe.xack(self.key, self.group, *ids)
+        pipe.xdel(self.key, *ids)
+        pipe.execute()
+
+    def drained(self):
+        # everything this process put has been read (by this writer or another one); entries other processes keep
+        # adding don't hold up the shutdown
+        return self._last_put_id is None or (self._last_read_id is not None and self._last_read_id >= self._last_put_id)
+
+    def __len__(self):
+        return self.r.xlen(self.key)
+
+
+class EventWriter(threading.Thread):
+    # Flushes the queue when `batch_size` events are waiting or `flush_interval` seconds have passed
+    def __init__(self, schema, events, batch_size=500, flush_interval=0.5, on_flush=None, update_marts=True):
+        super().__init__(name='event-writer', daemon=True)
+        self.schema = schema
+        self.events = events
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush  # called with the flushed batch after it is committed
+        self.update_marts = update_marts  # False when the mart change consumer (src/cdc.py) maintains the counters
+        self.max_attempts = 3
+        self._stopping = threading.Event()
+
+        self.failed_events = 0
+        self.flushed_events = 0
+        self.flushed_batches = 0
+        self.flush_time = 0.0
+
+    def run(self):
+        # once stopping, only what was queued by this process before the stop is drained
+        backoff = self.flush_interval
+        while not (self._stopping.is_set() and self.events.drained()):
+            try:
+                if not self._step() and self._stopping.is_set():
+                    return
+            except Exception:
+                # the queue failed (e.g. Redis is unreachable): keep the writer alive. Entries read but not
+                # acknowledged stay pending and are claimed again, so retrying can't lose events.
+                traceback.print_exc()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = self.flush_interval
+
+    def _step(self):
+        # reads and writes one batch; False when there was nothing to read
+        batch, ids = self.events.get_batch(self.batch_size, self.flush_interval)
+        if not batch:
+            return False
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.flush(batch)
+            except Exception:
+                traceback.print_exc()
+                if attempt == self.max_attempts:
+                    self._flush_isolating(batch, ids)
+                else:
+                    time.sleep(self.flush_interval * attempt)
+                continue
+            self.events.ack(ids)
+            break
+        return True
+
+    def _flush_isolating(self, batch, ids):
+        # The batch keeps failing: flush it in halves, so that only the events that can't be written (e.g. a
+        # diary_id that doesn't exist) end up in the dead letters and the others still get written.
+        try:
+            self.flush(batch)
+        except Exception as error:
+            if len(batch) == 1:
+                self.failed_events += 1
+                self.events.dead_letter(batch[0], ids, error)
+                return
+            middle = len(batch) // 2
+            self._flush_isolating(batch[:middle], ids[:middle] if ids else ids)
+            self._flush_isolating(batch[middle:], ids[middle:] if ids else ids)
+            return
+        self.events.ack(ids)
+
+    def flush(self, batch):
+        started = time.perf_counter()
+        activities = [e for e in batch if e['kind'] == 'activity']
+        diaries = [e for e in batch if e['kind'] == 'diary']
+
+        with pooled() as conn:
+            with conn.cursor() as cursor:
+                if diaries:
+                    execute_values(
+                        cursor,
+                        f"INSERT INTO {self.schema}.diary_records (diary_id, title, created_on, text, tags) VALUES %s",
+                        [(e['diary_id'], e['title'], e['created_on'], e['text'], e['tags']) for e in diaries],
+                        page_size=self.batch_size)
+
+                if activities:
+                    execute_values(
+                        cursor,
+                        f"INSERT INTO {self.schema}.user_activity (user_id, activity_type, activity_date) VALUES %s",
+                        [(e['user_id'], e['activity_type'], e['activity_date']) for e in activities],
+                        page_size=self.batch_size)
+
+                if activities and self.update_marts:
+                    counts = Counter((e['activity_type'], e['activity_date'].date(), e['activity_date'].hour)
+                                     for e in activities)
+                    bump_activity_counters(cursor, self.schema, counts)
+
+            conn.commit()
+
+        # the batch is committed: failures from here on must not make the writer insert it again
+        try:
+            if activities:
+                if self.update_marts:
+                    invalidate_hourly_activity(self.schema, [e['activity_date'].date() for e in activities])
+                get_active_users(self.schema).add((e['user_id'], e['activity_date']) for e in activities)
+
+            if self.on_flush:
+                self.on_flush(batch)
+        except Exception:
+            traceback.print_exc()
+
+        self.flushed_events += len(batch)
+        self.flushed_batches += 1
+        self.flush_time += time.perf_counter() - started
+
+    def stop(self, timeout=None):
+        # the writer drains what this process queued before it exits
+        self._stopping.set()
+        self.join(timeout)
+
+
+class IngestPipeline:
+    def __init__(self, schema, events, batch_size=500, flush_interval=0.5, put_timeout=5.0, on_flush=None,
+                 update_marts=True, stop_timeout=10.0):
+        self.events = events
+        self.put_timeout = put_timeout
+        self.stop_timeout = stop_timeout
+        self.writer = EventWriter(schema, events, batch_size, flush_interval, on_flush, update_marts)
+
+    def start(self):
+        self.writer.start()
+        return self
+
+    def stop(self):
+        self.writer.stop(self.stop_timeout)
+        if self.writer.is_alive():
+            # the durable queue keeps them for another writer, the in-memory one loses them at exit
+            print(f"Gave up waiting for the event writer after {self.stop_timeout:g}s, "
+                  f"{len(self.events)} events are still queued.")
+
+    def submit(self, event):
+        self.events.put(event, timeout=self.put_timeout)
+
+    def record_activity(self, user_id, activity_type, activity_date=None):
+        self.submit(activity_event(user_id, activity_type, activity_date))
+
+    def record_diary(self, diary_id, title, text, tags, created_on=None):
+        self.submit(diary_event(diary_id, title, text, tags, created_on))
+
+    def stats(self):
+        writer = self.writer
+        return {
+            'queued': len(self.events),
+            'flushed_events': writer.flushed_events,
+            'flushed_batches': writer.flushed_batches,
+            'failed_events': writer.failed_events,
+            'dead_letters': self.events.dead_letters,
+            'flush_time': writer.flush_time,
+        }
+
+
+def consumer_name():
+    # unique per process: a writer only ever reads its own pending entries, the stale ones of dead writers are claimed
+    prefix = config('INGEST_CONSUMER', default='writer')
+    return f"{prefix}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def create_pipeline(schema, on_flush=None):
+    # INGEST_BACKEND=memory (default) keeps events in-process, INGEST_BACKEND=redis makes them durable
+    # and lets several processes feed the same writer
+    backend = config('INGEST_BACKEND', default='memory')
+    if backend == 'redis':
+        events = RedisStreamEventQueue(get_redis(), f"{schema}.events",
+                                       consumer=consumer_name(),
+                                       maxlen=config('INGEST_QUEUE_SIZE', default=100000, cast=int))
+    elif backend == 'memory':
+        events = MemoryEventQueue(config('INGEST_QUEUE_SIZE', default=10000, cast=int))
+    else:
+        raise ValueError(f"Unknown INGEST_BACKEND {backend!r}, expected 'memory' or 'redis'")
+
+    return IngestPipeline(schema, events,
+                          batch_size=config('INGEST_BATCH_SIZE', default=500, cast=int),
+                          flush_interval=config('INGEST_FLUSH_INTERVAL', default=0.5, cast=float),
+                          on_flush=on_flush,
+                          update_marts=not config('MART_CDC', default=False, cast=bool),
+                          stop_timeout=config('INGEST_STOP_TIMEOUT', default=10.0, cast=float))
@@ -0,0 +1,310 @@
+import atexit
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+
+import psycopg2.extensions
+
+
+# Query instrumentation: connections created with InstrumentedConnection hand out cursors that time every statement
+# and record it under its normalized text (literals replaced by ?) with the calling function, rowcount and a
+# latency histogram. Statements slower than the threshold are logged, optionally with their plan.
+
+logger = logging.getLogger('src.sql')
+
+THIS_FILE = os.path.abspath(__file__)
+PROJECT_ROOT = os.path.dirname(os.path.dirname(THIS_FILE))
+
+# log-spaced latency buckets: bucket i holds durations in [BASE^i, BASE^(i+1)) microseconds, ~10% resolution
+HISTOGRAM_BASE = 1.1
+_LOG_BASE = math.log(HISTOGRAM_BASE)
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s")
+# casts of literals ('...'::timestamp, ?::numeric(10, 2), ?::text[]) would keep VALUES lists from collapsing
+_CAST_RE = re.compile(r"\?\s*::\s*(?:\w+|\"[^\"]*\")(?:\s*\.\s*\w+)?(?:\s*\(\s*\?(?:\s*,\s*\?)*\s*\))?"
+                      r"(?:\s+with(?:out)?\s+time\s+zone)?(?:\s*\[\s*\])*", re.IGNORECASE)
+_VALUES_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+_IN_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+_SPACE_RE = re.compile(r"\s+")
+_VALUES_RE = re.compile(r"\bVALUES\b", re.IGNORECASE)
+_VALUES_TAIL_RE = re.compile(r"\)\s*((?:ON\s+CONFLICT|RETURNING)\b.*)$", re.IGNORECASE | re.DOTALL)
+
+
+# Statements up to this length are normalized in full (and cached). Longer ones are mostly interpolated multi-row
+# INSERTs of execute_values (megabytes for a batch of diary records): running the regexes over all of it would cost
+# more than the statement is worth, so only the text around the VALUES list is looked at.
+CACHED_QUERY_LENGTH = 2000
+
+
+def normalize(query):
+    if len(query) <= CACHED_QUERY_LENGTH:
+        return _normalize_cached(query)
+
+    head, tail = query[:CACHED_QUERY_LENGTH], query[-CACHED_QUERY_LENGTH:]
+    if isinstance(query, bytes):
+        head, tail = head.decode('utf-8', 'replace'), tail.decode('utf-8', 'replace')
+    match = _VALUES_RE.search(head)
+    if match is None:
+        return _normalize(head) + ' ...'
+    # the same statement as the collapsed list of a short batch, with its ON CONFLICT / RETURNING clause
+    text = _normalize_cached(head[:match.end()]) + ' (...)'
+    clause = _VALUES_TAIL_RE.search(tail)
+    if clause:
+        text += ' ' + _normalize_cached(clause.group(1))
+    return text
+
+
+def _normalize(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = _STRING_RE.sub('?', query)
+    query = _PLACEHOLDER_RE.sub('?', query)
+    query = _NUMBER_RE.sub('?', query)
+    query = _CAST_RE.sub('?', query)
+    # multi-row VALUES and IN lists of any length map to the same statement
+    query = _VALUES_LIST_RE.sub('(...)', query)
+    query = _IN_LIST_RE.sub('...', query)
+    return _SPACE_RE.sub(' ', query).strip()
+
+
+_normalize_cached = lru_cache(maxsize=4096)(_normalize)
+
+
+def _caller():
+    # the innermost frame of the project's own code outside of this module
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PROJECT_ROOT) and filename != THIS_FILE and 'site-packages' not in filename:
+            module = os.path.relpath(filename, PROJECT_ROOT)
+            return f"{module}:{frame.f_code.co_name}"
+        frame = frame.f_back
+    return '?'
+
+
+class StatementStats:
+    __slots__ = ('calls', 'total_time', 'max_time', 'rows', 'histogram', 'callers')
+
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.histogram = Counter()
+        self.callers = Counter()
+
+    def add(self, seconds, rowcount, caller):
+        self.calls += 1
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+        if rowcount and rowcount > 0:
+            self.rows += rowcount
+        self.histogram[int(math.log(max(seconds * 1e6, 1.0)) / _LOG_BASE)] += 1
+        self.callers[caller] += 1
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        self.rows += other.rows
+        self.histogram.update(other.histogram)
+        self.callers.update(other.callers)
+
+    def percentile(self, p):
+        # upper bound of the bucket that holds the p-th percentile, in seconds
+        rank = p / 100 * self.calls
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return min(HISTOGRAM_BASE ** (bucket + 1) / 1e6, self.max_time)
+        return self.max_time
+
+    def to_dict(self):
+        return {
+            'calls': self.calls, 'total_time': self.total_time, 'max_time': self.max_time, 'rows': self.rows,
+            'histogram': {str(bucket): count for bucket, count in self.histogram.items()},
+            'callers': dict(self.callers),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.calls = data['calls']
+        stats.total_time = data['total_time']
+        stats.max_time = data['max_time']
+        stats.rows = data['rows']
+        stats.histogram = Counter({int(bucket): count for bucket, count in data['histogram'].items()})
+        stats.callers = Counter(data['callers'])
+        return stats
+
+
+class QueryStats:
+    def __init__(self, slow_threshold=0.2, explain_slow=False):
+        self.slow_threshold = slow_threshold
+        self.explain_slow = explain_slow
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def record(self, cursor, query, seconds, caller):
+        text = normalize(query)
+        with self._lock:
+            stats = self.statements.get(text)
+            if stats is None:
+                stats = self.statements[text] = StatementStats()
+            stats.add(seconds, cursor.rowcount, caller)
+
+        if seconds >= self.slow_threshold:
+            plan = self._explain(cursor) if self.explain_slow else None
+            logger.warning("slow query %.1f ms in %s, %s rows: %s%s", seconds * 1000, caller, cursor.rowcount,
+                           text, f"\n{plan}" if plan else '')
+
+    def _explain(self, cursor):
+        # Plain EXPLAIN (the statement is not run again) of read-only statements. cursor.query is the statement as
+        # sent to the server, with the parameters interpolated; for execute_values it is the last page.
+        query = cursor.query
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        if not query or cursor.name or not query.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return None
+        conn = cursor.connection
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return None
+
+        # a failing EXPLAIN must not abort the caller's transaction, nor leave one open on an idle connection
+        in_transaction = status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as explain_cursor:
+            try:
+                if in_transaction:
+                    explain_cursor.execute("SAVEPOINT query_stats_explain")
+                try:
+                    explain_cursor.execute(f"EXPLAIN {query}")
+                    return '\n'.join(row[0] for row in explain_cursor.fetchall())
+                except psycopg2.Error:
+                    if in_transaction:
+                        explain_cursor.execute("ROLLBACK TO SAVEPOINT query_stats_explain")
+                    return None
+                finally:
+                    if in_transaction:
+                        explain_cursor.execute("RELEASE SAVEPOINT query_stats_explain")
+                    elif not conn.autocommit:
+                        conn.rollback()
+            except psycopg2.Error:
+                return None
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+
+    def report(self):
+        with self._lock:
+            items = list(self.statements.items())
+        rows = []
+        for text, stats in items:
+            rows.append({
+                'statement': text,
+                'calls': stats.calls,
+                'total_ms': stats.total_time * 1000,
+                'mean_ms': stats.total_time / stats.calls * 1000,
+                'p50_ms': stats.percentile(50) * 1000,
+                'p95_ms': stats.percentile(95) * 1000,
+                'p99_ms': stats.percentile(99) * 1000,
+                'max_ms': stats.max_time * 1000,
+                'rows': stats.rows,
+                'callers': dict(stats.callers.most_common(3)),
+            })
+        return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+    def dump(self, path):
+        # stats already in the file (earlier runs, other processes) are merged in
+        with self._lock:
+            merged = {text: StatementStats.from_dict(stats.to_dict()) for text, stats in self.statements.items()}
+        if os.path.exists(path):
+            for text, data in load_stats(path).statements.items():
+                merged.setdefault(text, StatementStats()).merge(data)
+        with open(path, 'w') as f:
+            json.dump({text: stats.to_dict() for text, stats in merged.items()}, f)
+
+
+def load_stats(path):
+    stats = QueryStats()
+    with open(path) as f:
+        stats.statements = {text: StatementStats.from_dict(data) for text, data in json.load(f).items()}
+    return stats
+
+
+def print_report(stats, top=20):
+    print(f"{'calls':>8} {'total ms':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'rows':>9}  statement / callers")
+    for row in stats.report()[:top]:
+        print(f"{row['calls']:>8} {row['total_ms']:>10.1f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} "
+              f"{row['p99_ms']:>8.2f} {row['max_ms']:>8.2f} {row['rows']:>9}  {row['statement'][:120]}")
+        print(f"{'':>66}{', '.join(f'{caller} ({n})' for caller, n in row['callers'].items())}")
+
+
+query_stats = QueryStats()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            query_stats.record(self, query, time.perf_counter() - started, _caller())
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            query_stats.record(self, query, time.perf_counter() - started, _caller())
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            query_stats.record(self, sql, time.perf_counter() - started, _caller())
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+
+
+def configure(slow_query_ms=200, explain_slow=False, stats_file=None):
+    query_stats.slow_threshold = slow_query_ms / 1000
+    query_stats.explain_slow = explain_slow
+    if stats_file:
+        atexit.register(query_stats.dump, stats_file)
+
+
+@lru_cache(maxsize=None)
+def configure_from_env():
+    from decouple import config
+
+    configure(slow_query_ms=config('SLOW_QUERY_MS', default=200, cast=float),
+              explain_slow=config('SLOW_QUERY_EXPLAIN', default=False, cast=bool),
+              stats_file=config('QUERY_STATS_FILE', default='') or None)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print the statements recorded in a query stats dump")
+    parser.add_argument('path', nargs='?', default='query_stats.json')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    print_report(load_stats(args.path), args.top)
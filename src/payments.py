@@ -0,0 +1,127 @@
+import datetime
+import random
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Optional
+
+import psycopg2
+import psycopg2.errors
+from decouple import config
+from psycopg2.extras import execute_values
+
+from src.utils import pooled, get_pool
+
+
+# errors after which the whole chunk transaction can simply be run again
+RETRYABLE_ERRORS = (psycopg2.errors.SerializationFailure, psycopg2.errors.DeadlockDetected)
+
+
+@dataclass
+class PaymentResult:
+    user_id: int
+    plan_id: int
+    payment_date: datetime.date
+    ok: bool
+    amount: Optional[Decimal] = None
+    error: Optional[str] = None
+
+
+def _failure_reason(cursor, schema, user_id, plan_id):
+    # only called for payments that were not charged, to tell the caller why
+    cursor.execute(f"SELECT price FROM {schema}.subscription_plans WHERE plan_id = %s", (plan_id, ))
+    if cursor.fetchone() is None:
+        return f'Plan with ID {plan_id} does not exist.'
+    cursor.execute(f"SELECT 1 FROM {schema}.users WHERE user_id = %s", (user_id, ))
+    if cursor.fetchone() is None:
+        return f'User with ID {user_id} does not exist.'
+    return f'User with ID {user_id} does not have enough balance for this transaction to happen'
+
+
+def _charge_chunk(conn, schema, payments):
+    results = []
+    charged = []
+    with conn.cursor() as cursor:
+        # users are locked in id order, so that concurrent chunks can't deadlock on each other
+        for user_id, plan_id, payment_date in sorted(payments, key=lambda payment: payment[0]):
+            # the balance check and the debit are one statement: the row lock it takes makes concurrent
+            # payments of the same user wait and re-check the balance, no read-modify-write window
+            cursor.execute(
+                f"""
+                UPDATE {schema}.users u SET balance = u.balance - p.price
+                FROM {schema}.subscription_plans p
+                WHERE u.user_id = %s AND p.plan_id = %s AND u.balance >= p.price
+                RETURNING p.price
+                """,
+                (user_id, plan_id))
+            row = cursor.fetchone()
+            if row is None:
+                results.append(PaymentResult(user_id, plan_id, payment_date, False,
+                                             error=_failure_reason(cursor, schema, user_id, plan_id)))
+            else:
+                charged.append((user_id, plan_id, payment_date, row[0]))
+                results.append(PaymentResult(user_id, plan_id, payment_date, True, amount=row[0]))
+
+        if charged:
+            execute_values(
+                cursor,
+                f"INSERT INTO {schema}.payments (user_id, plan_id, payment_date, amount) VALUES %s",
+                charged, page_size=len(charged))
+
+    conn.commit()
+    return results
+
+
+def _process_chunk(schema, payments, max_attempts=5, backoff=0.01):
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with pooled() as conn:
+                return _charge_chunk(conn, schema, payments)
+        except RETRYABLE_ERRORS as error:
+            if attempt == max_attempts:
+                reason = f'Gave up after {attempt} attempts: {error}'.strip()
+                return [PaymentResult(*payment, ok=False, error=reason) for payment in payments]
+            # exponential backoff with full jitter
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        except psycopg2.Error as error:
+            return [PaymentResult(*payment, ok=False, error=str(error).strip()) for payment in payments]
+        except Exception as error:
+            # anything else (e.g. a pool that can't connect) fails this chunk only, the other chunks keep their results
+            traceback.print_exc()
+            return [PaymentResult(*payment, ok=False, error=f'{type(error).__name__}: {error}') for payment in payments]
+
+
+def pay_subscriptions(payments, schema: str = None, workers: int = 4, chunk_size: int = 100):
+    # Processes (user_id, plan_id, payment_date) tuples: chunks of `chunk_size` payments are charged in one
+    # transaction each (a conditional UPDATE per payment and one multi-row INSERT into payments), `workers`
+    # chunks at a time. Returns a PaymentResult per payment, in input order.
+    schema = schema or config('SCHEMA_NAME')
+    # a worker waiting for a connection longer than the pool timeout would fail its chunk
+    max_size = get_pool().max_size
+    if workers > max_size:
+        print(f"Using {max_size} workers, the size of the connection pool (DATABASE_POOL_MAX).")
+        workers = max_size
+    payments = list(payments)
+    chunks = [payments[i:i + chunk_size] for i in range(0, len(payments), chunk_size)]
+
+    if workers <= 1 or len(chunks) <= 1:
+        chunk_results = [_process_chunk(schema, chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            chunk_results = list(executor.map(lambda chunk: _process_chunk(schema, chunk), chunks))
+
+    # chunks are charged in user order; map the results back to the input order
+    by_payment = {}
+    for results in chunk_results:
+        for result in results:
+            by_payment.setdefault((result.user_id, result.plan_id, result.payment_date), []).append(result)
+    return [by_payment[tuple(payment)].pop() for payment in payments]
+
+
+def pay_subscription(user_id: int, plan_id: int, payment_date: datetime.date, schema: str = None) -> bool:
+    result = pay_subscriptions([(user_id, plan_id, payment_date)], schema=schema, workers=1)[0]
+    if not result.ok:
+        print(result.error)
+    return result.ok
@@ -1,33 +1,165 @@
-import re
-from collections import Counter
-import nltk
-from nltk.corpus import stopwords
+import datetime
+import time
+from collections import defaultdict
+from functools import lru_cache
 import redis
+from decouple import config
+
+from src.tokenizer import default_tokenizer
+
+
+# Merges the per-bucket ZSETs of the window into one ZSET, at most once per refresh interval, and reads the top of it.
+# KEYS[1] - merged window key, KEYS[2..] - bucket keys of the window; ARGV[1] - merged key TTL (ms), ARGV[2] - top N
+READ_TRENDING_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('ZUNIONSTORE', KEYS[1], #KEYS - 1, unpack(KEYS, 2))
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+end
+return redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+"""
 
 
 class TrendingTopics:
-    def __init__(self, host='localhost', port=6379, password=None, db=0, prefix='psyassist'):
-        self.r = redis.Redis(host=host, port=port, password=password, db=db)
+    # Word counts are kept in one ZSET per time bucket (a minute by default) that expires once it leaves the window.
+    # Trending words are the top of the union of the buckets in the window; the union is cached for `refresh_time`
+    # seconds, so a read is a single ZREVRANGE on an already merged ZSET most of the time.
+    def __init__(self, host='localhost', port=6379, password=None, db=0, prefix='psyassist',
+                 window=5 * 60, bucket_size=60, refresh_time=5, tokenizer=None, client=None):
+        self.r = client or redis.Redis(host=host, port=port, password=password, db=db)
         self.prefix = prefix
         self.key = f'{self.prefix}.trending_topics'
-        self.expire_time = 5 * 60  # 5 minutes
+        self.expire_time = window
+        self.bucket_size = bucket_size
+        self.refresh_time = refresh_time
+        self._read_trending = self.r.register_script(READ_TRENDING_SCRIPT)
+        self.tokenizer = tokenizer or default_tokenizer()
+
+    def _bucket(self, timestamp=None):
+        return int((time.time() if timestamp is None else timestamp) // self.bucket_size)
+
+    def _bucket_key(self, bucket):
+        return f"{self.key}:{bucket}"
+
+    def update_trending(self, new_entry, timestamp=None):
+        self.add_counts(self.tokenizer.count(new_entry), timestamp)
+
+    def update_trending_many(self, entries, timestamp=None):
+        self.add_counts(self.tokenizer.count_many(entries), timestamp)
+
+    def add_counts(self, word_counts, timestamp=None):
+        self.add_bucket_counts({self._bucket(timestamp): word_counts})
+
+    def add_bucket_counts(self, bucket_counts, batch_size=1000):
+        # bucket_counts maps a time bucket (see _bucket) to a Counter of words; increments are pipelined
+        # in batches of `batch_size` commands, a single entry goes out in one round-trip
+        pipe = self.r.pipeline(transaction=False)
+        queued = 0
+        for bucket, word_counts in bucket_counts.items():
+            if not word_counts:
+                continue
+            key = self._bucket_key(bucket)
+            for word, count in word_counts.items():
+                pipe.zincrby(key, count, word)
+                queued += 1
+                if queued >= batch_size:
+                    pipe.execute()
+                    queued = 0
+            # the bucket expires when it slides out of the window
+            pipe.expireat(key, (bucket + 1) * self.bucket_size + self.expire_time)
+            queued += 1
+        if queued:
+            pipe.execute()
+
+    def invalidate(self):
+        # drop the cached merge of the window, e.g. after a bulk load
+        self.r.delete(f"{self.key}:window")
+
+    def clear(self, since=None):
+        # drop the buckets from `since` (epoch seconds, the start of the window by default) up to the current one
+        # and the cached merge, e.g. before they are rebuilt from the database
+        since = time.time() - self.expire_time if since is None else since
+        buckets = range(self._bucket(since), self._bucket() + 1)
+        keys = [f"{self.key}:window"] + [self._bucket_key(bucket) for bucket in buckets]
+        for i in range(0, len(keys), 1000):
+            self.r.delete(*keys[i:i + 1000])
+
+    def get_trending(self, count=10):
+        current = self._bucket()
+        buckets = range(current - max(1, self.expire_time // self.bucket_size) + 1, current + 1)
+        keys = [f"{self.key}:window"] + [self._bucket_key(bucket) for bucket in buckets]
+        return self._read_trending(keys=keys, args=[int(self.refresh_time * 1000), count])
+
+
+class ActiveUsers:
+    # Approximate distinct active users in HyperLogLogs: one per day and one per hour (~12 KB each at most,
+    # 0.81% standard error). Ranges of days are counted by PFMERGE-ing the daily keys.
+    def __init__(self, client, prefix='psyassist', day_ttl_days=400, hour_ttl_days=8):
+        self.r = client
+        self.key = f'{prefix}.active_users'
+        self.day_ttl = day_ttl_days * 24 * 3600
+        self.hour_ttl = hour_ttl_days * 24 * 3600
+
+    def _day_key(self, day):
+        return f"{self.key}:d:{day:%Y-%m-%d}"
+
+    def _hour_key(self, moment):
+        return f"{self.key}:h:{moment:%Y-%m-%d}:{moment.hour:02d}"
+
+    def add(self, events):
+        # events: iterable of (user_id, activity datetime); one pipelined round-trip for the whole batch
+        keys = defaultdict(set)
+        for user_id, moment in events:
+            keys[(self._day_key(moment), self.day_ttl)].add(user_id)
+            keys[(self._hour_key(moment), self.hour_ttl)].add(user_id)
+        if not keys:
+            return
+
+        pipe = self.r.pipeline(transaction=False)
+        for (key, ttl), user_ids in keys.items():
+            pipe.pfadd(key, *user_ids)
+            pipe.expire(key, ttl)
+        pipe.execute()
+
+    def day(self, day):
+        return self.r.pfcount(self._day_key(day))
+
+    def hour(self, moment):
+        return self.r.pfcount(self._hour_key(moment))
+
+    def range(self, first_day, last_day):
+        # distinct users over [first_day, last_day]: the daily HLLs are merged into a short-lived key and counted
+        days = [first_day + datetime.timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        merged = f"{self.key}:r:{first_day:%Y-%m-%d}:{last_day:%Y-%m-%d}"
+        pipe = self.r.pipeline(transaction=False)
+        pipe.pfmerge(merged, *(self._day_key(day) for day in days))
+        pipe.expire(merged, 60)
+        pipe.pfcount(merged)
+        return pipe.execute()[-1]
+
+    def dau(self, day=None):
+        day = day or datetime.date.today()
+        return self.day(day)
+
+    def wau(self, day=None):
+        day = day or datetime.date.today()
+        return self.range(day - datetime.timedelta(days=6), day)
 
-        nltk.download('stopwords')
+    def mau(self, day=None):
+        day = day or datetime.date.today()
+        return self.range(day - datetime.timedelta(days=29), day)
 
-    def update_trending(self, new_entry):
-        words = re.findall(r'\b\w{4,}\b', new_entry.lower())
-        words = [word for word in words if word not in stopwords.words('english')]
 
-        word_counts = Counter(words)
+@lru_cache(maxsize=None)
+def get_redis():
+    # one process-wide client (and connection pool) configured from .env
+    return redis.Redis(host=config('REDIS_HOST'), port=config('REDIS_PORT'), password=config('REDIS_PASSWORD'))
 
-        for word, count in word_counts.items():
-            self.r.zincrby(self.key, count, word)
 
-            self.r.setex(f"{self.prefix}.{word}", self.expire_time, '')
+@lru_cache(maxsize=None)
+def get_trending_topics():
+    return TrendingTopics(client=get_redis())
 
-    def get_trending(self):
-        for word in self.r.zrevrange(self.key, 0, -1):
-            if not self.r.exists(f"{self.prefix}.{word.decode()}"):
-                self.r.zrem(self.key, word)
 
-        return self.r.zrevrange(self.key, 0, 9)
\ No newline at end of file
+@lru_cache(maxsize=None)
+def get_active_users(schema):
+    return ActiveUsers(get_redis(), prefix=schema)
@@ -0,0 +1,88 @@
+import datetime
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+# Full-text search over diary records, served by the GIN indexes on the generated search_vector and tag_list
+# columns (see utils.ensure_diary_search).
+
+SEARCH_PAGE_SIZE = 20
+
+# ts_rank normalization 1: divide by 1 + log(document length), so long records don't win by size alone
+RANK_NORMALIZATION = 1
+
+HEADLINE_OPTIONS = 'MaxFragments=1, MaxWords=20, MinWords=5, StartSel=[, StopSel=]'
+
+
+@dataclass
+class DiaryMatch:
+    record_id: int
+    diary_id: int
+    title: str
+    created_on: datetime.datetime
+    tags: List[str]
+    rank: Optional[float]
+    snippet: str
+
+
+def normalize_tags(tags):
+    # same normalization as the generated tag_list column
+    return sorted({tag.strip().lower() for tag in tags if tag.strip()})
+
+
+def search_diary_records(conn, schema, query='', tags=(), user_id=None, after=None, limit=SEARCH_PAGE_SIZE):
+    # Records matching `query` (web search syntax: words, "phrases", OR, -word) and carrying all of `tags`,
+    # optionally only from the diary of `user_id`. With a query, the best ranked records come first, otherwise
+    # the newest. `after` is the key returned with the previous page: pages are read by keyset on
+    # (rank or created_on, record_id), so deep pages cost the same as the first one.
+    # Returns (matches, key of the next page or None).
+    query = query.strip()
+    tags = normalize_tags(tags)
+    if not query and not tags:
+        raise ValueError("Search needs a query or at least one tag")
+
+    params = {'query': query, 'tags': tags, 'user_id': user_id, 'limit': limit + 1,
+              'normalization': RANK_NORMALIZATION}
+    if query:
+        order_value = "ts_rank(r.search_vector, q, %(normalization)s)"
+        conditions = ["r.search_vector @@ q"]
+        after_value = "%(after_value)s::real"
+    else:
+        order_value = "r.created_on"
+        conditions = []
+        after_value = "%(after_value)s"
+
+    if tags:
+        conditions.append("r.tag_list @> %(tags)s::text[]")
+    if user_id is not None:
+        conditions.append(f"r.diary_id IN (SELECT diary_id FROM {schema}.diaries WHERE user_id = %(user_id)s)")
+    if after:
+        conditions.append(f"({order_value}, r.record_id) < ({after_value}, %(after_id)s)")
+        params['after_value'], params['after_id'] = after
+
+    # the snippet is highlighted only for the rows of the page, ts_headline re-parses the whole text
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH search AS (SELECT websearch_to_tsquery('english', %(query)s) AS q),
+            page AS (
+                SELECT r.record_id, r.diary_id, r.title, r.created_on, r.text, r.tag_list, {order_value} AS order_value
+                FROM {schema}.diary_records r, search
+                WHERE {' AND '.join(conditions)}
+                ORDER BY order_value DESC, r.record_id DESC
+                LIMIT %(limit)s
+            )
+            SELECT record_id, diary_id, title, created_on, tag_list, order_value,
+                   CASE WHEN %(query)s = '' THEN left(text, 120)
+                        ELSE ts_headline('english', text, q, '{HEADLINE_OPTIONS}') END
+            FROM page, search
+            ORDER BY order_value DESC, record_id DESC
+            """,
+            params)
+        rows = cursor.fetchall()
+
+    matches = [DiaryMatch(record_id, diary_id, title, created_on, tag_list or [],
+                          order_value if query else None, snippet)
+               for record_id, diary_id, title, created_on, tag_list, order_value, snippet in rows[:limit]]
+    next_key = (rows[limit - 1][5], rows[limit - 1][0]) if len(rows) > limit else None
+    return matches, next_key
@@ -0,0 +1,261 @@
+import argparse
+import csv
+import datetime
+import io
+import multiprocessing
+import random
+import secrets
+import time
+from collections import defaultdict
+
+import bcrypt
+import redis
+from faker import Faker
+from psycopg2.extras import execute_values
+
+from src.redis_utils import get_active_users
+from src.utils import pooled, close_pool, ensure_schema, drop_tables, create_tables, build_activity_datamart
+
+
+# Scale factor 1 is 1 000 users; the per-user row counts stay fixed, so every table grows linearly with it
+USERS_PER_SCALE = 1000
+DEFAULT_RECORDS_PER_USER = 10
+DEFAULT_ACTIVITIES_PER_USER = 10
+DEFAULT_PAYMENTS_PER_USER = 1
+
+# Faker is far too slow to call per row at this volume, so each worker draws from pools generated once
+VOCABULARY_SIZE = 1000
+
+# Seeding tables in dependency order, so that a batch never references rows that are not loaded yet
+SEED_TABLES = ('users', 'diaries', 'payments', 'diary_records', 'user_activity')
+
+_worker_state = {}
+
+
+def _hash_password(open_pwd):
+    return bcrypt.hashpw(open_pwd.encode(), bcrypt.gensalt()).decode()
+
+
+def hash_password_pool(size, pool):
+    # bcrypt is deliberately slow, so hash a fixed set of passwords once (in parallel) and reuse them
+    fake = Faker()
+    open_pwds = [fake.password() for _ in range(size)]
+    return open_pwds, pool.map(_hash_password, open_pwds)
+
+
+def _init_worker(schema, hashed_pwds, plans, options):
+    fake = Faker()
+    _worker_state.update(
+        schema=schema,
+        hashed_pwds=hashed_pwds,
+        plans=plans,
+        options=options,
+        names=[fake.name() for _ in range(VOCABULARY_SIZE)],
+        domains=[fake.domain_name() for _ in range(VOCABULARY_SIZE // 10)],
+        titles=[fake.sentence() for _ in range(VOCABULARY_SIZE)],
+        texts=[fake.text(max_nb_chars=500) for _ in range(VOCABULARY_SIZE)],
+        words=[fake.word() for _ in range(VOCABULARY_SIZE)],
+    )
+
+
+def _random_timestamp(rnd, now, days):
+    return now - datetime.timedelta(seconds=rnd.randrange(days * 24 * 3600))
+
+
+def _generate_batch(first_user_id, first_diary_id, count, rnd):
+    state = _worker_state
+    options = state['options']
+    now = datetime.datetime.now()
+
+    rows = {table: [] for table in SEED_TABLES}
+    for i in range(count):
+        user_id = first_user_id + i
+        diary_id = first_diary_id + i
+
+        # emails are derived from the id so that they are unique without a round-trip
+        rows['users'].append((
+            user_id, f"user{user_id}@{rnd.choice(state['domains'])}", round(rnd.uniform(0, 10000), 2),
+            rnd.choice(state['names']), rnd.choice(state['hashed_pwds']), _random_timestamp(rnd, now, 365),
+        ))
+        rows['diaries'].append((diary_id, user_id))
+
+        for _ in range(options['payments_per_user']):
+            plan_id, price = rnd.choice(state['plans'])
+            rows['payments'].append((user_id, plan_id, _random_timestamp(rnd, now, 365), price))
+
+        for _ in range(options['records_per_user']):
+            rows['diary_records'].append((
+                diary_id, rnd.choice(state['titles']), _random_timestamp(rnd, now, 365),
+                rnd.choice(state['texts']), ','.join(rnd.sample(state['words'], 5)),
+            ))
+
+        # same two types of activity as seed_tables: entering the system and adding diary records
+        for _ in range(options['activities_per_user']):
+            rows['user_activity'].append((
+                user_id, rnd.choice(('login', 'diary_record')), _random_timestamp(rnd, now, 30),
+            ))
+
+    return rows
+
+
+SEED_COLUMNS = {
+    'users': '(user_id, email, balance, name, password, created_on)',
+    'diaries': '(diary_id, user_id)',
+    'payments': '(user_id, plan_id, payment_date, amount)',
+    'diary_records': '(diary_id, title, created_on, text, tags)',
+    'user_activity': '(user_id, activity_type, activity_date)',
+}
+
+
+def _copy_rows(cursor, schema, table, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {schema}.{table} {SEED_COLUMNS[table]} FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _seed_batch(batch):
+    batch_no, first_user_id, first_diary_id, count = batch
+    schema = _worker_state['schema']
+
+    # a fixed seed per batch keeps a given scale factor reproducible regardless of scheduling
+    rnd = random.Random(batch_no)
+
+    started = time.perf_counter()
+    rows = _generate_batch(first_user_id, first_diary_id, count, rnd)
+    generate_time = time.perf_counter() - started
+
+    stats = {}
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            # the marts are rebuilt once at the end, change notifications (src/cdc.py) would only duplicate that
+            cursor.execute("SET LOCAL mart_cdc.disabled = on")
+            for table in SEED_TABLES:
+                started = time.perf_counter()
+                _copy_rows(cursor, schema, table, rows[table])
+                stats[table] = (len(rows[table]), time.perf_counter() - started)
+        conn.commit()
+
+    try:
+        get_active_users(schema).add((user_id, activity_date) for user_id, _, activity_date in rows['user_activity'])
+    except redis.RedisError as error:
+        # the rows are committed; the approximate active user counts just miss this batch
+        print(f"Warning: active users of batch {batch_no} not counted, Redis failed: {error}")
+
+    return stats, generate_time
+
+
+def _insert_plans(cursor, schema, num_plans):
+    fake = Faker()
+    # plan names are unique, so suffix them to allow seeding the same schema more than once
+    plans = [(f"{fake.word()}-{secrets.token_hex(3)}", fake.text(max_nb_chars=100), round(random.uniform(1, 100), 2))
+             for _ in range(num_plans)]
+    execute_values(
+        cursor,
+        f"INSERT INTO {schema}.subscription_plans (name, plans, price) VALUES %s RETURNING plan_id, price",
+        plans,
+        fetch=True,
+    )
+    return [(plan_id, float(price)) for plan_id, price in cursor.fetchall()]
+
+
+def seed_tables_bulk(schema: str, scale: float = 1, *, records_per_user=DEFAULT_RECORDS_PER_USER,
+                     activities_per_user=DEFAULT_ACTIVITIES_PER_USER, payments_per_user=DEFAULT_PAYMENTS_PER_USER,
+                     num_plans=3, batch_size=5000, workers=None, password_pool_size=64):
+    num_users = max(1, int(scale * USERS_PER_SCALE))
+    workers = workers or multiprocessing.cpu_count()
+
+    print(f"Generating data - scale {scale}: {num_users} users, {records_per_user} records, "
+          f"{activities_per_user} activities and {payments_per_user} payments for each, {workers} workers.")
+
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            plans = _insert_plans(cursor, schema, num_plans)
+
+            # users and diaries get explicit ids, so batches can reference them without reading anything back
+            cursor.execute(f"SELECT COALESCE(MAX(user_id), 0) + 1 FROM {schema}.users")
+            first_user_id = cursor.fetchone()[0]
+            cursor.execute(f"SELECT COALESCE(MAX(diary_id), 0) + 1 FROM {schema}.diaries")
+            first_diary_id = cursor.fetchone()[0]
+        conn.commit()
+
+    # workers open their own connections; don't fork while holding ours
+    close_pool()
+
+    batches = [
+        (batch_no, first_user_id + offset, first_diary_id + offset, min(batch_size, num_users - offset))
+        for batch_no, offset in enumerate(range(0, num_users, batch_size))
+    ]
+
+    totals = defaultdict(lambda: [0, 0.0])
+    generate_time = 0.0
+    started = time.perf_counter()
+
+    with multiprocessing.Pool(workers) as pool:
+        open_pwds, hashed_pwds = hash_password_pool(password_pool_size, pool)
+        print(f"Hashed {len(hashed_pwds)} passwords in {time.perf_counter() - started:.1f}s "
+              f"(every seeded user has one of: {', '.join(open_pwds[:3])}, ...)")
+
+    # the pool is recreated so that every worker is initialised with the password hashes
+    options = dict(records_per_user=records_per_user, activities_per_user=activities_per_user,
+                   payments_per_user=payments_per_user)
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(schema, hashed_pwds, plans, options)) as pool:
+        for done, (stats, batch_generate_time) in enumerate(pool.imap_unordered(_seed_batch, batches), 1):
+            generate_time += batch_generate_time
+            for table, (rows, seconds) in stats.items():
+                totals[table][0] += rows
+                totals[table][1] += seconds
+            if done % max(1, len(batches) // 10) == 0:
+                print(f"  {done}/{len(batches)} batches, {time.perf_counter() - started:.1f}s")
+
+    elapsed = time.perf_counter() - started
+
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            # explicit ids bypassed the sequences
+            for table, column in (('users', 'user_id'), ('diaries', 'diary_id')):
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{schema}.{table}', '{column}'), "
+                    f"(SELECT MAX({column}) FROM {schema}.{table}))"
+                )
+
+            build_activity_datamart(cursor, schema)
+            conn.commit()
+
+            for table in SEED_TABLES:
+                cursor.execute(f"ANALYZE {schema}.{table}")
+            conn.commit()
+
+    print(f"\nData generated in {elapsed:.1f}s ({generate_time:.1f}s generating rows across workers).")
+    # load s is summed over the workers that ran in parallel, rows/s is over the wall-clock time of the whole load
+    print("table\trows\tload s\trows/s")
+    for table in SEED_TABLES:
+        rows, seconds = totals[table]
+        rate = rows / elapsed if elapsed else 0.0
+        print(f"{table}\t{rows}\t{seconds:.1f}\t{rate:,.0f}")
+    total_rows = sum(rows for rows, _ in totals.values())
+    print(f"total\t{total_rows}\t\t{total_rows / elapsed if elapsed else 0.0:,.0f}")
+
+    return {table: {'rows': rows, 'load_seconds': seconds} for table, (rows, seconds) in totals.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk seeding for load tests")
+    parser.add_argument('--scale', type=float, default=1, help=f"scale factor, {USERS_PER_SCALE} users per unit")
+    parser.add_argument('--records-per-user', type=int, default=DEFAULT_RECORDS_PER_USER)
+    parser.add_argument('--activities-per-user', type=int, default=DEFAULT_ACTIVITIES_PER_USER)
+    parser.add_argument('--payments-per-user', type=int, default=DEFAULT_PAYMENTS_PER_USER)
+    parser.add_argument('--batch-size', type=int, default=5000, help="users per batch")
+    parser.add_argument('--workers', type=int, default=None, help="processes, defaults to the CPU count")
+    parser.add_argument('--recreate', action='store_true', help="drop and recreate the tables first")
+    args = parser.parse_args()
+
+    schema = ensure_schema(drop_if_exists=False)
+    if args.recreate:
+        drop_tables(schema)
+    create_tables(schema)
+
+    seed_tables_bulk(schema, args.scale, records_per_user=args.records_per_user,
+                     activities_per_user=args.activities_per_user, payments_per_user=args.payments_per_user,
+                     batch_size=args.batch_size, workers=args.workers)
@@ -0,0 +1,179 @@
+import argparse
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from decouple import config
+
+from src.utils import pooled, ensure_schema
+
+
+# Columnar snapshots of the marts for analysis outside of Postgres. Every column is a flat little-endian binary file
+# (`<dir>/<mart>/<column>.bin`) described by `manifest.json`: row count, dtypes, the last exported day and the
+# dictionaries of dictionary-encoded text columns. Exports append the complete days (before today) newer than the
+# last exported one; load_snapshot memory-maps the files read-only, so reading a snapshot copies nothing until the
+# data is touched. Days the marts recompute after they were exported (reconcile, backfill) need export(full=True).
+
+# mart -> (day column, ORDER BY, columns as (name, dtype, dictionary encoded))
+SNAPSHOT_MARTS = {
+    'daily_analytics_data_mart': ('date', 'date', [
+        ('date', '<M8[D]', False),
+        ('total_active_users', '<i8', False),
+        ('total_diary_records', '<i8', False),
+        ('average_text_length', '<f8', False),
+        ('total_subscription', '<i8', False),
+        ('total_revenue', '<f8', False),
+    ]),
+    'user_activity_datamart': ('activity_date', 'activity_date, activity_hour, activity_type', [
+        ('activity_date', '<M8[D]', False),
+        ('activity_hour', '<i1', False),
+        ('activity_type', '<i2', True),
+        ('activity_count', '<i8', False),
+    ]),
+}
+
+MANIFEST = 'manifest.json'
+
+
+def snapshot_dir(directory=None):
+    return directory or config('SNAPSHOT_DIR', default='snapshots')
+
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _write_manifest(path, manifest):
+    # written to a temporary file and renamed, so readers see either the old or the new snapshot
+    tmp_path = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def _column_path(path, column):
+    return os.path.join(path, f"{column}.bin")
+
+
+def _encode(rows, index, dtype, dictionary):
+    values = [row[index] for row in rows]
+    if dictionary is not None:
+        codes = {value: code for code, value in enumerate(dictionary)}
+        for value in values:
+            if value not in codes:
+                codes[value] = len(dictionary)
+                dictionary.append(value)
+        values = [codes[value] for value in values]
+    # NULLs of float columns become NaN
+    return np.array(values, dtype=dtype)
+
+
+def export_mart(schema: str, mart: str, directory: str = None, full: bool = False, chunk_size: int = 50000):
+    # Append the complete days of `mart` newer than the snapshot (all of them with full=True).
+    # Returns the number of rows appended.
+    day_column, order_by, columns = SNAPSHOT_MARTS[mart]
+    path = os.path.join(snapshot_dir(directory), mart)
+    os.makedirs(path, exist_ok=True)
+
+    manifest = None if full else read_manifest(path)
+    if manifest is None:
+        manifest = {
+            'mart': mart,
+            'rows': 0,
+            'last_date': None,
+            'columns': {name: dtype for name, dtype, _ in columns},
+            'dictionaries': {name: [] for name, _, encoded in columns if encoded},
+        }
+
+    # drop whatever an interrupted export appended after the rows the manifest accounts for
+    for name, dtype, _ in columns:
+        with open(_column_path(path, name), 'ab') as f:
+            f.truncate(manifest['rows'] * np.dtype(dtype).itemsize)
+
+    last_date = datetime.date.fromisoformat(manifest['last_date']) if manifest['last_date'] else datetime.date.min
+    # the current day is still changing, it is exported once it is over
+    until = datetime.date.today()
+
+    appended = 0
+    new_last_date = manifest['last_date']
+    files = {name: open(_column_path(path, name), 'ab') for name, _, _ in columns}
+    try:
+        with pooled() as conn:
+            with conn.cursor(name='export_mart') as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(
+                    f"""SELECT {', '.join(name for name, _, _ in columns)} FROM {schema}.{mart}
+                    WHERE {day_column} > %s AND {day_column} < %s ORDER BY {order_by}""",
+                    (last_date, until))
+
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for index, (name, dtype, encoded) in enumerate(columns):
+                        dictionary = manifest['dictionaries'][name] if encoded else None
+                        files[name].write(_encode(rows, index, dtype, dictionary).tobytes())
+                    appended += len(rows)
+                    new_last_date = rows[-1][0].isoformat()
+            conn.commit()
+    finally:
+        for f in files.values():
+            f.close()
+
+    manifest['rows'] += appended
+    manifest['last_date'] = new_last_date
+    manifest['exported_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+    _write_manifest(path, manifest)
+    return appended
+
+
+def export_snapshot(schema: str, directory: str = None, full: bool = False):
+    for mart in SNAPSHOT_MARTS:
+        appended = export_mart(schema, mart, directory, full)
+        print(f"{mart}: {appended} rows appended to the snapshot.")
+
+
+def load_snapshot(mart: str, directory: str = None):
+    # column name -> read-only np.memmap of the snapshot; dictionary-encoded columns hold the codes, see
+    # snapshot_frame for decoded values. Returns the manifest too.
+    path = os.path.join(snapshot_dir(directory), mart)
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError(f"No snapshot of {mart} in {path}, export it first")
+
+    arrays = {}
+    for name, dtype in manifest['columns'].items():
+        if manifest['rows'] == 0:
+            # an empty file can't be mapped
+            arrays[name] = np.empty(0, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(_column_path(path, name), dtype=dtype, mode='r', shape=(manifest['rows'], ))
+    return arrays, manifest
+
+
+def snapshot_frame(mart: str, directory: str = None) -> pd.DataFrame:
+    # DataFrame over the memory-mapped columns; dictionary-encoded columns become categoricals over their codes.
+    # Numeric columns are not copied, pandas converts the day columns to its nanosecond datetimes.
+    arrays, manifest = load_snapshot(mart, directory)
+    columns = {}
+    for name, values in arrays.items():
+        if name in manifest['dictionaries']:
+            columns[name] = pd.Categorical.from_codes(values, categories=manifest['dictionaries'][name])
+        else:
+            columns[name] = pd.Series(values, name=name, copy=False)
+    return pd.DataFrame(columns, copy=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the marts to a columnar memory-mappable snapshot")
+    parser.add_argument('--dir', default=None, help="snapshot directory (SNAPSHOT_DIR, defaults to ./snapshots)")
+    parser.add_argument('--full', action='store_true', help="rewrite the snapshot instead of appending new days")
+    args = parser.parse_args()
+
+    export_snapshot(ensure_schema(drop_if_exists=False), args.dir, args.full)
@@ -0,0 +1,44 @@
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from itertools import filterfalse
+
+
+STOPWORDS_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+@lru_cache(maxsize=None)
+def load_stopwords(language='english'):
+    # the stopword lists are bundled (a copy of the NLTK corpus), so no download is needed at runtime;
+    # languages that are not bundled fall back to an already downloaded NLTK corpus
+    path = os.path.join(STOPWORDS_DIR, f'stopwords_{language}.txt')
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return frozenset(line.strip() for line in f if line.strip())
+
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words(language))
+
+
+class Tokenizer:
+    # Splits diary text into lowercase words of at least `min_length` characters, without stopwords
+    def __init__(self, stopwords=None, min_length=4, language='english'):
+        self.pattern = re.compile(rf'\b\w{{{min_length},}}\b')
+        self.stopwords = frozenset(stopwords) if stopwords is not None else load_stopwords(language)
+
+    def tokenize(self, text):
+        return list(filterfalse(self.stopwords.__contains__, self.pattern.findall(text.lower())))
+
+    def count(self, text):
+        return Counter(filterfalse(self.stopwords.__contains__, self.pattern.findall(text.lower())))
+
+    def count_many(self, texts):
+        # one lower() and one regex scan over the whole batch instead of one per entry;
+        # entries are joined with a newline, which is a word boundary, so no words are merged
+        return self.count('\n'.join(texts))
+
+
+@lru_cache(maxsize=None)
+def default_tokenizer():
+    return Tokenizer()
@@ -0,0 +1,95 @@
+import argparse
+import datetime
+import multiprocessing
+import time
+from collections import defaultdict, deque
+
+from src.redis_utils import get_trending_topics
+from src.tokenizer import default_tokenizer
+from src.utils import pooled, close_pool
+
+
+def _count_chunk(chunk):
+    # chunk: (bucket_size, [(epoch seconds, text), ...]) -> {bucket: Counter of words}
+    bucket_size, rows = chunk
+    texts = defaultdict(list)
+    for timestamp, text in rows:
+        texts[int(timestamp // bucket_size)].append(text)
+
+    tokenizer = default_tokenizer()
+    return {bucket: tokenizer.count_many(bucket_texts) for bucket, bucket_texts in texts.items()}, len(rows)
+
+
+def backfill_trending(schema: str, minutes=None, chunk_size=5000, workers=None, batch_size=1000):
+    # Rebuilds the trending window from the diary records of the last `minutes` (the trending window by default),
+    # e.g. after Redis was restarted or flushed. Records are streamed with a server-side cursor, tokenized in a
+    # worker pool and pushed per time bucket; at most 2 chunks per worker are in flight, so memory stays bounded.
+    # The buckets of the period are cleared first, so the counts the writers left there are not added twice.
+    trending = get_trending_topics()
+    minutes = minutes or trending.expire_time / 60
+    workers = workers or multiprocessing.cpu_count()
+    since = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
+
+    rows_done = 0
+    words_pushed = 0
+    started = time.perf_counter()
+    last_report = started
+
+    def push(result):
+        nonlocal rows_done, words_pushed, last_report
+        bucket_counts, rows = result
+        trending.add_bucket_counts(bucket_counts, batch_size=batch_size)
+        rows_done += rows
+        words_pushed += sum(sum(counts.values()) for counts in bucket_counts.values())
+
+        now = time.perf_counter()
+        if now - last_report >= 5:
+            last_report = now
+            print(f"  {rows_done} records, {words_pushed} words, {rows_done / (now - started):,.0f} records/s")
+
+    # the worker processes don't touch the database, but don't fork while holding connections anyway
+    close_pool()
+    with multiprocessing.Pool(workers) as pool:
+        with pooled() as conn:
+            with conn.cursor(name='trending_backfill') as cursor:
+                cursor.itersize = chunk_size
+                # right before the query takes its snapshot, only entries written in between are counted twice
+                trending.clear(since.timestamp())
+                cursor.execute(
+                    f"SELECT created_on, text FROM {schema}.diary_records WHERE created_on >= %s",
+                    (since, ))
+
+                pending = deque()
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    chunk = (trending.bucket_size, [(created_on.timestamp(), text) for created_on, text in rows])
+                    pending.append(pool.apply_async(_count_chunk, (chunk, )))
+                    if len(pending) >= 2 * workers:
+                        push(pending.popleft().get())
+
+                while pending:
+                    push(pending.popleft().get())
+
+            conn.rollback()
+
+    trending.invalidate()
+
+    elapsed = time.perf_counter() - started
+    print(f"Trending backfill done: {rows_done} records since {since:%Y-%m-%d %H:%M}, {words_pushed} words "
+          f"in {elapsed:.1f}s ({rows_done / elapsed if elapsed else 0:,.0f} records/s).")
+    return rows_done, words_pushed
+
+
+if __name__ == '__main__':
+    from decouple import config
+
+    parser = argparse.ArgumentParser(description="Rebuild the trending topics window from diary_records")
+    parser.add_argument('--minutes', type=float, default=None, help="how far back to go, the trending window by default")
+    parser.add_argument('--chunk-size', type=int, default=5000, help="records fetched and tokenized per chunk")
+    parser.add_argument('--workers', type=int, default=None, help="tokenizer processes, defaults to the CPU count")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Redis commands per pipeline")
+    args = parser.parse_args()
+
+    backfill_trending(config('SCHEMA_NAME'), args.minutes, args.chunk_size, args.workers, args.batch_size)
@@ -1,9 +1,15 @@
-import bcrypt
 import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
 from decouple import config
-from faker import Faker
 import random
 import datetime
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from src.instrumentation import InstrumentedConnection, configure_from_env as configure_query_stats
 
 
 def connect():
@@ -13,310 +19,654 @@ def connect():
     DATABASE_HOST = config('DATABASE_HOST')
     DATABASE_PORT = config('DATABASE_PORT')
 
+    # every statement is timed and recorded by the instrumented connection unless QUERY_STATS is off
+    connection_factory = None
+    if config('QUERY_STATS', default=True, cast=bool):
+        configure_query_stats()
+        connection_factory = InstrumentedConnection
+
     connection = psycopg2.connect(
         database=DATABASE_NAME,
         user=DATABASE_USERNAME,
         password=DATABASE_PASSWORD,
         host=DATABASE_HOST,
-        port=DATABASE_PORT
+        port=DATABASE_PORT,
+        connection_factory=connection_factory
     )
 
     return connection
 
 
-def ensure_schema(*, drop_if_exists=False):
-    SCHEMA_NAME = config('SCHEMA_NAME')
-    conn = connect()
-    with conn.cursor() as cursor:
-        if drop_if_exists:
-            confirm = input(f"ARE YOU SURE WANT TO DROP SCHEMA {SCHEMA_NAME} WITH ALL OBJECTS? Type 'y' do drop...")
-            if confirm == 'y':
-                query = f"DROP SCHEMA if exists {SCHEMA_NAME} CASCADE"
-                cursor.execute(query)
-                conn.commit()
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Process-wide pool of psycopg2 connections. Connections are created lazily with connect()
+    # up to max_size; when all of them are checked out, callers wait (up to `timeout` seconds)
+    # for one to be returned. Idle connections are health-checked before being handed out.
+
+    def __init__(self, min_size=1, max_size=10, timeout=30.0, health_check_interval=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = []  # (connection, returned_at) pairs, most recently returned last
+        self._size = 0  # open connections, idle + checked out
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+        self._checked_out = 0
+        self._waiters = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+        for _ in range(min_size):
+            self._idle.append((connect(), time.monotonic()))
+            self._size += 1
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
 
-        query = f"CREATE SCHEMA if not exists {SCHEMA_NAME}"
-        cursor.execute(query)
-        conn.commit()
+    def _discard(self, conn):
+        self._discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        started = time.monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve the slot before leaving the lock to open a new connection
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"No connection available within {self.timeout}s "
+                                      f"(max_size={self.max_size})")
+                waited = True
+                self._waiters += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+
+        if conn is not None and not self._is_healthy(conn, returned_at):
+            self._discard(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        wait_time = time.monotonic() - started
+        with self._cond:
+            self._checked_out += 1
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+
+        return conn
+
+    def putconn(self, conn, *, discard=False):
+        if not discard and not conn.closed:
+            # never hand out a connection in the middle of a transaction
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._checked_out -= 1
+            if discard or conn.closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'checked_out': self._checked_out,
+                'waiters': self._waiters,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time,
+                'wait_time_avg': self._wait_time / self._waits if self._waits else 0.0,
+                'wait_time_max': self._max_wait_time,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_inherited_pools = []
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        # connections must not be shared with a forked child, so a new process gets its own pool.
+        # The inherited one stays referenced: closing it here would terminate the parent's sessions.
+        if _pool is not None and _pool._pid != os.getpid():
+            _inherited_pools.append(_pool)
+            _pool = None
+        if _pool is None:
+            _pool = ConnectionPool(
+                min_size=config('DATABASE_POOL_MIN', default=1, cast=int),
+                max_size=config('DATABASE_POOL_MAX', default=10, cast=int),
+                timeout=config('DATABASE_POOL_TIMEOUT', default=30.0, cast=float),
+                health_check_interval=config('DATABASE_POOL_HEALTH_CHECK_INTERVAL', default=30.0, cast=float),
+            )
+        return _pool
 
-    conn.close()
-    return SCHEMA_NAME
 
+@contextmanager
+def pooled():
+    # connections come back to the pool with any unfinished transaction rolled back;
+    # broken connections are dropped and replaced on the next checkout
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
 
-def drop_tables(schema: str):
-    conn = connect()
-    with conn.cursor() as cur:
-        cur.execute(f"""DROP TABLE IF EXISTS {schema}.user_activity_datamart CASCADE;""")
-        cur.execute(f"""DROP TABLE IF EXISTS {schema}.user_activity CASCADE;""")
-        cur.execute(f"""DROP TABLE IF EXISTS {schema}.diary_records CASCADE;""")
-        cur.execute(f"""DROP TABLE IF EXISTS {schema}.diaries CASCADE ;""")
-        cur.execute(f"""DROP TABLE IF EXISTS {schema}.payments CASCADE ;""")
-        cur.execute(f"""DROP TABLE IF EXISTS {schema}.users CASCADE;""")
-        cur.execute(f"""DROP TABLE IF EXISTS {schema}.subscription_plans CASCADE;""")
-
-        # Commit the changes
-        conn.commit()
 
-    # Close the connection to the PostgreSQL database
-    conn.close()
+def pool_stats():
+    return get_pool().stats()
 
 
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
 
-def create_tables(schema: str):
-    conn = connect()
-    with conn.cursor() as cursor:
-        query = f"""
-        CREATE TABLE if not exists {schema}.users (
-            user_id SERIAL PRIMARY KEY,
-            email VARCHAR(255) UNIQUE NOT NULL,
-            balance FLOAT,
-            name VARCHAR(255) NOT NULL,
-            password VARCHAR(255) NOT NULL,
-            created_on TIMESTAMP NOT NULL
-        );
-        """
-        cursor.execute(query)
-        conn.commit()
 
-        query = f"""
-            CREATE TABLE if not exists {schema}.subscription_plans (
-                plan_id SERIAL PRIMARY KEY,
-                name VARCHAR(255) UNIQUE NOT NULL,
-                plans TEXT NOT NULL,
-                price DECIMAL(10,2) NOT NULL
+def ensure_schema(*, drop_if_exists=False):
+    SCHEMA_NAME = config('SCHEMA_NAME')
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            if drop_if_exists:
+                confirm = input(f"ARE YOU SURE WANT TO DROP SCHEMA {SCHEMA_NAME} WITH ALL OBJECTS? Type 'y' do drop...")
+                if confirm == 'y':
+                    query = f"DROP SCHEMA if exists {SCHEMA_NAME} CASCADE"
+                    cursor.execute(query)
+                    conn.commit()
+
+            query = f"CREATE SCHEMA if not exists {SCHEMA_NAME}"
+            cursor.execute(query)
+            conn.commit()
+    return SCHEMA_NAME
+
+
+def drop_tables(schema: str):
+    with pooled() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.user_activity_datamart CASCADE;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.user_activity CASCADE;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.diary_records CASCADE;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.diaries CASCADE ;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.payments CASCADE ;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.users CASCADE;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.subscription_plans CASCADE;""")
+            # the marts and their bookkeeping describe the dropped rows, and the ids restart below their watermarks
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.daily_analytics_data_mart;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.mart_watermarks;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.backfill_chunks;""")
+            cur.execute(f"""DROP TABLE IF EXISTS {schema}.backfill_runs;""")
+
+            # Commit the changes
+            conn.commit()
+
+
+def create_tables(schema: str):
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            query = f"""
+            CREATE TABLE if not exists {schema}.users (
+                user_id SERIAL PRIMARY KEY,
+                email VARCHAR(255) UNIQUE NOT NULL,
+                balance FLOAT,
+                name VARCHAR(255) NOT NULL,
+                password VARCHAR(255) NOT NULL,
+                created_on TIMESTAMP NOT NULL
             );
-        """
-        cursor.execute(query)
-        conn.commit()
+            """
+            cursor.execute(query)
+            conn.commit()
 
-        query = f"""
-        CREATE TABLE if not exists {schema}.payments (
-            payment_id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL REFERENCES {schema}.users(user_id),
-            plan_id INTEGER NOT NULL REFERENCES {schema}.subscription_plans(plan_id),
-            payment_date TIMESTAMP NOT NULL,
-            amount NUMERIC(10, 2) NOT NULL
-        );
-        """
-        cursor.execute(query)
-        conn.commit()
+            query = f"""
+                CREATE TABLE if not exists {schema}.subscription_plans (
+                    plan_id SERIAL PRIMARY KEY,
+                    name VARCHAR(255) UNIQUE NOT NULL,
+                    plans TEXT NOT NULL,
+                    price DECIMAL(10,2) NOT NULL
+                );
+            """
+            cursor.execute(query)
+            conn.commit()
 
-        query = f"""
-        CREATE TABLE if not exists {schema}.diaries (
-            diary_id SERIAL PRIMARY KEY,
-            user_id INTEGER UNIQUE NOT NULL REFERENCES {schema}.users(user_id)
-        );
-        """
-        cursor.execute(query)
-        conn.commit()
+            query = f"""
+            CREATE TABLE if not exists {schema}.payments (
+                payment_id SERIAL PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES {schema}.users(user_id),
+                plan_id INTEGER NOT NULL REFERENCES {schema}.subscription_plans(plan_id),
+                payment_date TIMESTAMP NOT NULL,
+                amount NUMERIC(10, 2) NOT NULL
+            );
+            """
+            cursor.execute(query)
+            conn.commit()
 
-        query = f"""
-        CREATE TABLE if not exists {schema}.diary_records (
-            record_id SERIAL PRIMARY KEY,
-            diary_id INTEGER NOT NULL REFERENCES {schema}.diaries(diary_id),
-            title VARCHAR(255) NOT NULL,
-            created_on TIMESTAMP NOT NULL,
-            text TEXT NOT NULL,
-            tags TEXT -- Assuming a comma-separated list of tags, you can adjust this based on your needs
-        );
-        """
-        cursor.execute(query)
-        conn.commit()
+            query = f"""
+            CREATE TABLE if not exists {schema}.diaries (
+                diary_id SERIAL PRIMARY KEY,
+                user_id INTEGER UNIQUE NOT NULL REFERENCES {schema}.users(user_id)
+            );
+            """
+            cursor.execute(query)
+            conn.commit()
 
-    # create table for storing user activity. For now we have two types of activity: entering the system and adding diary records
-    with conn.cursor() as cursor:
-        query = f"""
-        CREATE TABLE if not exists {schema}.user_activity (
-            activity_id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL REFERENCES {schema}.users(user_id),
-            activity_type VARCHAR(255) NOT NULL,
-            activity_date TIMESTAMP NOT NULL
-        );
-        """
-        cursor.execute(query)
+            query = f"""
+            CREATE TABLE if not exists {schema}.diary_records (
+                record_id SERIAL PRIMARY KEY,
+                diary_id INTEGER NOT NULL REFERENCES {schema}.diaries(diary_id),
+                title VARCHAR(255) NOT NULL,
+                created_on TIMESTAMP NOT NULL,
+                text TEXT NOT NULL,
+                tags TEXT -- Assuming a comma-separated list of tags, you can adjust this based on your needs
+            );
+            """
+            cursor.execute(query)
+            conn.commit()
 
-        # create indexes on activity_type, user_id and activity_date columns
-        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_type ON {schema}.user_activity(activity_type);""")
-        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_user_id ON {schema}.user_activity(user_id);""")
-        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_date ON {schema}.user_activity(activity_date);""")
+        # the search columns are added while the table is still empty, so the rows are written with them
+        ensure_diary_search(schema, conn=conn)
+
+        # create table for storing user activity. For now we have two types of activity: entering the system and adding diary records
+        with conn.cursor() as cursor:
+            query = f"""
+            CREATE TABLE if not exists {schema}.user_activity (
+                activity_id SERIAL,
+                user_id INTEGER NOT NULL REFERENCES {schema}.users(user_id),
+                activity_type VARCHAR(255) NOT NULL,
+                activity_date TIMESTAMP NOT NULL,
+                PRIMARY KEY (activity_id, activity_date)
+            ) PARTITION BY RANGE (activity_date);
+            """
+            cursor.execute(query)
 
-        conn.commit()
+            # create indexes on activity_type, user_id and activity_date columns (they are created on every partition)
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_type ON {schema}.user_activity(activity_type);""")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_user_id ON {schema}.user_activity(user_id);""")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_date ON {schema}.user_activity(activity_date);""")
 
+            # activity outside of the monthly partitions (far past or future) lands here until its month is created.
+            # A legacy unpartitioned table keeps working as it is, maintain_activity_partitions reports it below.
+            if activity_partitioned(cursor, schema):
+                cursor.execute(f"""CREATE TABLE IF NOT EXISTS {schema}.user_activity_default PARTITION OF {schema}.user_activity DEFAULT;""")
 
-    # create datamart table to analyze counts of users activity by day, type of activity and hour of the day
-    # table should contain the following columns: record_id, activity_type, activity_date, activity_hour, activity_count
-    # activity_count should be calculated as a number of records for each activity type and hour of the day
-    # we need indexes on activity_type, activity_date and activity_hour columns
-    with conn.cursor() as cursor:
-        query = f"""
-        CREATE TABLE if not exists {schema}.user_activity_datamart (
-            record_id SERIAL PRIMARY KEY,
-            activity_type VARCHAR(255) NOT NULL,
-            activity_date DATE NOT NULL,
-            activity_hour INTEGER NOT NULL,
-            activity_count INTEGER NOT NULL
-        );
-        """
-        cursor.execute(query)
+            conn.commit()
 
-        # create indexes
-        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_type ON {schema}.user_activity_datamart(activity_type);""")
-        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_date ON {schema}.user_activity_datamart(activity_date);""")
-        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_hour ON {schema}.user_activity_datamart(activity_hour);""")
+        maintain_activity_partitions(schema, conn=conn)
+
+
+        # create datamart table to analyze counts of users activity by day, type of activity and hour of the day
+        # table should contain the following columns: record_id, activity_type, activity_date, activity_hour, activity_count
+        # activity_count should be calculated as a number of records for each activity type and hour of the day
+        # we need indexes on activity_type, activity_date and activity_hour columns
+        with conn.cursor() as cursor:
+            query = f"""
+            CREATE TABLE if not exists {schema}.user_activity_datamart (
+                record_id SERIAL PRIMARY KEY,
+                activity_type VARCHAR(255) NOT NULL,
+                activity_date DATE NOT NULL,
+                activity_hour INTEGER NOT NULL,
+                activity_count INTEGER NOT NULL
+            );
+            """
+            cursor.execute(query)
 
-        conn.commit()
+            # create indexes
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_type ON {schema}.user_activity_datamart(activity_type);""")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_date ON {schema}.user_activity_datamart(activity_date);""")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_activity_hour ON {schema}.user_activity_datamart(activity_hour);""")
+
+            conn.commit()
 
-    conn.close()
+    ensure_activity_datamart_key(schema)
+    ensure_user_lookup_indexes(schema)
 
     print("Tables created.")
 
 
-def seed_tables(schema: str):
-    fake = Faker()
-
-    # Connect to the database
-    conn = connect()
+def ensure_user_lookup_indexes(schema: str):
+    # prefix search over lowercased email and name for the login (see console_ui.find_users). The "C" collation
+    # lets the same btree serve both LIKE 'prefix%' and the ORDER BY of the keyset pagination.
+    with pooled() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_users_email_lookup ON {schema}.users ((lower(email)) COLLATE "C", user_id);""")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_users_name_lookup ON {schema}.users ((lower(name)) COLLATE "C", user_id);""")
+            conn.commit()
 
-    num_users = 3
-    num_plans = 3
-    num_records_per_user = 100
 
-    print(f"Generating data - {num_users} users, {num_records_per_user} records for each.")
+def ensure_diary_search(schema: str, conn=None):
+    # full-text search over diary records (see src/search.py). Both columns are generated from the ones the writers
+    # already fill: the title weighs more than the text, and the comma-separated tags become a lowercased array.
+    # create_tables adds them to new tables; adding them to an existing table rewrites it once. The ALTER TABLE takes
+    # an ACCESS EXCLUSIVE lock even when the columns exist, so it only runs when one is missing.
+    if conn is None:
+        with pooled() as conn:
+            return ensure_diary_search(schema, conn)
 
     with conn.cursor() as cursor:
-        # Insert fake subscription plans with random price
-        for _ in range(num_plans):
-            name = fake.word()
-            plans = fake.text(max_nb_chars=100)
-            price = round(random.uniform(1, 100), 2)
+        cursor.execute(
+            """SELECT count(*) FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = 'diary_records' AND column_name IN ('search_vector', 'tag_list')""",
+            (schema, ))
+        if cursor.fetchone()[0] < 2:
             cursor.execute(
-                f"INSERT INTO {schema}.subscription_plans (name, plans, price) VALUES (%s, %s, %s)",
-                (name, plans, price)
+                f"""
+                ALTER TABLE {schema}.diary_records
+                ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+                    setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                    setweight(to_tsvector('english', text), 'B')
+                ) STORED,
+                ADD COLUMN IF NOT EXISTS tag_list TEXT[] GENERATED ALWAYS AS (
+                    regexp_split_to_array(NULLIF(lower(btrim(tags, ' ,')), ''), '\\s*,\\s*')
+                ) STORED;
+                """
             )
-
+        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_diary_records_search ON {schema}.diary_records USING GIN (search_vector);""")
+        cursor.execute(f"""CREATE INDEX IF NOT EXISTS idx_diary_records_tags ON {schema}.diary_records USING GIN (tag_list);""")
         conn.commit()
 
-        # Insert fake users, payments, diaries, and diary_records
-        for _ in range(num_users):
-            # Insert user
-            salt = bcrypt.gensalt()
-            email = fake.email()
-            open_pwd = fake.password()
-            balance = fake.random.uniform(0, 10000)
-            pwd = bcrypt.hashpw(open_pwd.encode(), salt).decode()
+
+def _month_start(day: datetime.date, months: int = 0) -> datetime.date:
+    month = day.year * 12 + day.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def _activity_partition_months(cursor, schema: str):
+    # month start -> partition name of the monthly partitions of user_activity
+    cursor.execute(
+        """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE n.nspname = %s AND p.relname = 'user_activity' AND c.relname ~ '^user_activity_p[0-9]{6}$'
+        """,
+        (schema, ))
+    return {datetime.date(int(name[-6:-2]), int(name[-2:]), 1): name for name, in cursor.fetchall()}
+
+
+def activity_partitioned(cursor, schema: str) -> bool:
+    # user_activity tables created before partitioning are plain tables
+    cursor.execute(
+        """SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = %s AND c.relname = 'user_activity'""",
+        (schema, ))
+    return cursor.fetchone() is not None
+
+
+def maintain_activity_partitions(schema: str, months_ahead: int = None, retention_months: int = None, conn=None):
+    # Creates the monthly partitions of user_activity from the start of the retention period up to `months_ahead`
+    # months in the future, and drops partitions that are entirely older than the retention period.
+    # Meant to run on every start (and from a scheduler); all steps are idempotent.
+    months_ahead = config('ACTIVITY_PARTITIONS_AHEAD', default=3, cast=int) if months_ahead is None else months_ahead
+    retention_months = config('ACTIVITY_RETENTION_MONTHS', default=12, cast=int) if retention_months is None else retention_months
+
+    if conn is None:
+        with pooled() as conn:
+            return maintain_activity_partitions(schema, months_ahead, retention_months, conn)
+
+    today = datetime.date.today()
+    oldest = _month_start(today, -(retention_months - 1))
+
+    with conn.cursor() as cursor:
+        if not activity_partitioned(cursor, schema):
+            print(f"{schema}.user_activity is not partitioned, recreate the tables to enable partitioning.")
+            return
+
+        existing = _activity_partition_months(cursor, schema)
+        created, dropped = [], []
+
+        for i in range(retention_months + months_ahead):
+            month = _month_start(oldest, i)
+            if month in existing:
+                continue
+            name = f"user_activity_p{month:%Y%m}"
+            bounds = (month, _month_start(month, 1))
+
+            # rows of this month that went to the default partition are moved, otherwise attaching fails
+            cursor.execute(f"CREATE TABLE {schema}.{name} (LIKE {schema}.user_activity INCLUDING DEFAULTS)")
             cursor.execute(
-                f"INSERT INTO {schema}.users (email, name, password, balance, created_on) VALUES (%s, %s, %s, %s, %s) RETURNING user_id",
-                (email, fake.name(), pwd, balance, fake.date_between(start_date='-1y', end_date='today'))
-            )
-            user_id = cursor.fetchone()[0]
+                f"""
+                WITH moved AS (
+                    DELETE FROM {schema}.user_activity_default
+                    WHERE activity_date >= %s AND activity_date < %s
+                    RETURNING *
+                )
+                INSERT INTO {schema}.{name} SELECT * FROM moved
+                """,
+                bounds)
+            cursor.execute(
+                f"ALTER TABLE {schema}.user_activity ATTACH PARTITION {schema}.{name} FOR VALUES FROM (%s) TO (%s)",
+                bounds)
+            created.append(name)
+
+        # retention: whole partitions are dropped instead of deleting rows
+        for month, name in sorted(existing.items()):
+            if month < oldest:
+                cursor.execute(f"DROP TABLE {schema}.{name}")
+                dropped.append(name)
+        cursor.execute(f"DELETE FROM {schema}.user_activity_default WHERE activity_date < %s", (oldest, ))
+
+        conn.commit()
 
-            print(f"Created user {user_id} {email} with pwd {open_pwd}")
+    if created or dropped:
+        print(f"user_activity partitions: created {', '.join(created) or 'none'}; dropped {', '.join(dropped) or 'none'}.")
 
-            # Select random subscription plan
-            cursor.execute(f"SELECT plan_id FROM {schema}.subscription_plans ORDER BY RANDOM() LIMIT 1")
-            plan_id = cursor.fetchone()[0]
 
-            # Insert payment
+def ensure_activity_datamart_key(schema: str):
+    # counters are upserted by (activity_type, activity_date, activity_hour), so the mart needs a unique key on it.
+    # Older marts could contain duplicated slices: one row of each is kept and reconcile_actions_datamart
+    # (src/analytics.py) repairs the counts.
+    with pooled() as conn:
+        with conn.cursor() as cursor:
             cursor.execute(
-                f"INSERT INTO {schema}.payments (user_id, plan_id, payment_date, amount) VALUES (%s, %s, %s, %s)",
-                (user_id, random.randint(1, num_plans), fake.date_between(start_date='-1y', end_date='today'),
-                 fake.random_number(digits=2))
+                f"""
+                DELETE FROM {schema}.user_activity_datamart a
+                USING {schema}.user_activity_datamart b
+                WHERE a.activity_type = b.activity_type AND a.activity_date = b.activity_date
+                  AND a.activity_hour = b.activity_hour AND a.record_id > b.record_id
+                """
             )
-
-            # Insert diary
             cursor.execute(
-                f"INSERT INTO {schema}.diaries (user_id) VALUES (%s) RETURNING diary_id",
-                (user_id,)
+                f"""CREATE UNIQUE INDEX IF NOT EXISTS user_activity_datamart_key
+                ON {schema}.user_activity_datamart(activity_type, activity_date, activity_hour);"""
             )
-            diary_id = cursor.fetchone()[0]
+            conn.commit()
+
+
+def bump_activity_counters(cursor, schema: str, counts):
+    # counts: {(activity_type, activity_date, activity_hour): number of new events}. One multi-row upsert;
+    # slices are sorted so that concurrent writers lock the counter rows in the same order.
+    execute_values(
+        cursor,
+        f"""
+        INSERT INTO {schema}.user_activity_datamart (activity_type, activity_date, activity_hour, activity_count)
+        VALUES %s
+        ON CONFLICT (activity_type, activity_date, activity_hour)
+        DO UPDATE SET activity_count = {schema}.user_activity_datamart.activity_count + EXCLUDED.activity_count
+        """,
+        [(activity_type, date, hour, count) for (activity_type, date, hour), count in sorted(counts.items())])
+
+
+def build_activity_datamart(cursor, schema: str):
+    # Fill datamart table with data based on user activity table data
+    # We will use this table to analyze user activity by day, type of activity and hour of the day
+    cursor.execute(
+        f"""
+        INSERT INTO {schema}.user_activity_datamart (activity_type, activity_date, activity_hour, activity_count)
+        SELECT activity_type, date(activity_date), EXTRACT(HOUR FROM activity_date) as activity_hour, COUNT(*) as activity_count
+        FROM {schema}.user_activity
+        GROUP BY activity_type, date(activity_date), EXTRACT(HOUR FROM activity_date)
+        ORDER BY date(activity_date), activity_hour
+        ON CONFLICT (activity_type, activity_date, activity_hour) DO UPDATE SET activity_count = EXCLUDED.activity_count
+        """
+    )
+
 
-            # Insert diary records
-            for _ in range(num_records_per_user):
+def seed_tables(schema: str):
+    # only the demo seeding needs these, keep them out of the startup of every other command
+    import bcrypt
+    from faker import Faker
+
+    fake = Faker()
+
+    # Connect to the database
+    with pooled() as conn:
+
+        num_users = 3
+        num_plans = 3
+        num_records_per_user = 100
+
+        print(f"Generating data - {num_users} users, {num_records_per_user} records for each.")
+
+        activity = []
+
+        with conn.cursor() as cursor:
+            # Insert fake subscription plans with random price
+            for _ in range(num_plans):
+                name = fake.word()
+                plans = fake.text(max_nb_chars=100)
+                price = round(random.uniform(1, 100), 2)
                 cursor.execute(
-                    f"INSERT INTO {schema}.diary_records (diary_id, title, created_on, text, tags) VALUES (%s, %s, %s, %s, %s)",
-                    (diary_id, fake.sentence(), fake.date_between(start_date='-1y', end_date='today'),
-                     fake.text(max_nb_chars=500), ','.join(fake.words(nb=5)))
+                    f"INSERT INTO {schema}.subscription_plans (name, plans, price) VALUES (%s, %s, %s)",
+                    (name, plans, price)
                 )
 
-            # Fill user activity table with random data. We will use this table to populate the datamart
-            # We will assume that users enter the system and add diary records
-            # We have two types of activity: entering the system (name: login) and adding diary records (diary_record)
-            for _ in range(num_records_per_user):
+            conn.commit()
+
+            # Insert fake users, payments, diaries, and diary_records
+            for _ in range(num_users):
+                # Insert user
+                salt = bcrypt.gensalt()
+                email = fake.email()
+                open_pwd = fake.password()
+                balance = fake.random.uniform(0, 10000)
+                pwd = bcrypt.hashpw(open_pwd.encode(), salt).decode()
                 cursor.execute(
-                    f"INSERT INTO {schema}.user_activity (user_id, activity_type, activity_date) VALUES (%s, %s, %s)",
-                    (user_id, random.choice(['login', 'diary_record']), fake.date_time_between(start_date='-30d', end_date='now'))
+                    f"INSERT INTO {schema}.users (email, name, password, balance, created_on) VALUES (%s, %s, %s, %s, %s) RETURNING user_id",
+                    (email, fake.name(), pwd, balance, fake.date_between(start_date='-1y', end_date='today'))
                 )
+                user_id = cursor.fetchone()[0]
 
-            conn.commit()
+                print(f"Created user {user_id} {email} with pwd {open_pwd}")
 
-    # Fill datamart table with data based on user activity table data
-    # We will use this table to analyze user activity by day, type of activity and hour of the day
-    with conn.cursor() as cursor:
-        cursor.execute(
-            f"""
-            INSERT INTO {schema}.user_activity_datamart (activity_type, activity_date, activity_hour, activity_count)
-            SELECT activity_type, date(activity_date), EXTRACT(HOUR FROM activity_date) as activity_hour, COUNT(*) as activity_count
-            FROM {schema}.user_activity
-            GROUP BY activity_type, date(activity_date), EXTRACT(HOUR FROM activity_date)
-            ORDER BY date(activity_date), activity_hour
-            """
-        )
-        conn.commit()
+                # Select random subscription plan
+                cursor.execute(f"SELECT plan_id FROM {schema}.subscription_plans ORDER BY RANDOM() LIMIT 1")
+                plan_id = cursor.fetchone()[0]
 
-    conn.close()
+                # Insert payment
+                cursor.execute(
+                    f"INSERT INTO {schema}.payments (user_id, plan_id, payment_date, amount) VALUES (%s, %s, %s, %s)",
+                    (user_id, random.randint(1, num_plans), fake.date_between(start_date='-1y', end_date='today'),
+                     fake.random_number(digits=2))
+                )
 
-    print("Data generated.")
+                # Insert diary
+                cursor.execute(
+                    f"INSERT INTO {schema}.diaries (user_id) VALUES (%s) RETURNING diary_id",
+                    (user_id,)
+                )
+                diary_id = cursor.fetchone()[0]
+
+                # Insert diary records
+                for _ in range(num_records_per_user):
+                    cursor.execute(
+                        f"INSERT INTO {schema}.diary_records (diary_id, title, created_on, text, tags) VALUES (%s, %s, %s, %s, %s)",
+                        (diary_id, fake.sentence(), fake.date_between(start_date='-1y', end_date='today'),
+                         fake.text(max_nb_chars=500), ','.join(fake.words(nb=5)))
+                    )
+
+                # Fill user activity table with random data. We will use this table to populate the datamart
+                # We will assume that users enter the system and add diary records
+                # We have two types of activity: entering the system (name: login) and adding diary records (diary_record)
+                for _ in range(num_records_per_user):
+                    activity_date = fake.date_time_between(start_date='-30d', end_date='now')
+                    cursor.execute(
+                        f"INSERT INTO {schema}.user_activity (user_id, activity_type, activity_date) VALUES (%s, %s, %s)",
+                        (user_id, random.choice(['login', 'diary_record']), activity_date)
+                    )
+                    activity.append((user_id, activity_date))
 
+                conn.commit()
 
-def pay_subscription(user_id: int, plan_id: int, payment_date: datetime.date) -> bool:
-    # establish the database connection and begin transaction
-    conn = None
+        with conn.cursor() as cursor:
+            build_activity_datamart(cursor, schema)
+            conn.commit()
+
+    # approximate distinct active users counters (src/redis_utils.py)
+    import redis
+    from src.redis_utils import get_active_users
     try:
-        conn = connect()
-        cursor = conn.cursor()
-        cursor.execute("SET TRANSACTION ISOLATION LEVEL SERIALIZABLE;")
-        cursor.execute('BEGIN TRANSACTION')
-
-        # get the price of the subscription plan
-        sql = 'SELECT price FROM subscription_plans WHERE plan_id = %s'
-        cursor.execute(sql, (plan_id,))
-
-        amount = cursor.fetchone()[0]
-        # check if the plan_id exists in the subscription_plans table
-        if amount is None:
-            print(f'Plan with ID {plan_id} does not exist.')
-            raise ValueError(f'Plan with ID {plan_id} does not exist.')
-
-        # get the balance of the user
-        sql = 'SELECT balance FROM subscription_plans WHERE user_id = %s'
-        cursor.execute(sql, (user_id,))
-
-        balance = cursor.fetchone()[0]
-        # check if the user exists
-        if balance is None:
-            print(f'User with ID {user_id} does not exist.')
-            raise ValueError(f'User with ID {user_id} does not exist.')
-
-        assert balance >= amount, f'User with ID {user_id} does not have enough balance for this transaction to happen'
-
-        # insert the user transaction data into the database
-        sql = 'INSERT INTO user_transactions (user_id, plan_id, payment_date, amount) VALUES (%s, %s, %s, %s)'
-        cursor.execute(sql, (user_id, plan_id, payment_date, amount))
-
-        # update the balance of the user
-        balance -= amount
-        sql = 'UPDATE users SET balance = %s WHERE user_id = %s'
-        cursor.execute(sql, (balance, user_id))
-
-        # commit the transaction
-        conn.commit()
-    except Exception as error:
-        # rollback the transaction if an error occurs
-        if conn:
-            conn.rollback()
-        print(str(error))
-    finally:
-        # close the database connection
-        if conn:
-            conn.close()
+        get_active_users(schema).add(activity)
+    except redis.RedisError as error:
+        print(f"Warning: active users not counted, Redis failed: {error}")
 
+    print("Data generated.")